@@ -0,0 +1,142 @@
+"""
+Synthetic benchmark programs, each looping forever over one kind of
+instruction. The generated .ch8 files are shipped in benchmarks/roms and
+rebuilt with:
+
+    python3 -m benchmarks.roms
+"""
+import os
+import struct
+
+ROMS_DIRECTORY = os.path.join(os.path.dirname(__file__), 'roms')
+
+# Name -> (description, {address: opcodes})
+ROMS = {
+    'alu': ('8XYN arithmetic and 7XNN additions', {
+        0x200: [
+            0x6000,  # 200 LD V0, 0x00
+            0x6100,  # 202 LD V1, 0x00
+            0x62FF,  # 204 LD V2, 0xFF
+            0x7001,  # 206 ADD V0, 0x01
+            0x8104,  # 208 ADD V1, V0
+            0x8314,  # 20A ADD V3, V1
+            0x8435,  # 20C SUB V4, V3
+            0x8541,  # 20E OR V5, V4
+            0x8652,  # 210 AND V6, V5
+            0x8763,  # 212 XOR V7, V6
+            0x8877,  # 214 SUBN V8, V7
+            0x8906,  # 216 SHR V9
+            0x8A11,  # 218 OR VA, V1
+            0x8A0E,  # 21A SHL VA
+            0x8A22,  # 21C AND VA, V2
+            0x3000,  # 21E SE V0, 0x00
+            0x1206,  # 220 JP 0x206
+            0x1200,  # 222 JP 0x200
+        ],
+    }),
+    'sprites': ('DXYN sprites, wrapping around the display edges', {
+        0x200: [
+            0x6000,  # 200 LD V0, 0x00
+            0x6100,  # 202 LD V1, 0x00
+            0x630F,  # 204 LD V3, 0x0F
+            0xA300,  # 206 LD I, 0x300
+            0xD01F,  # 208 DRW V0, V1, 0xF
+            0x7005,  # 20A ADD V0, 0x05
+            0x7103,  # 20C ADD V1, 0x03
+            0xF229,  # 20E LD F, V2
+            0xD015,  # 210 DRW V0, V1, 0x5
+            0x7201,  # 212 ADD V2, 0x01
+            0x8232,  # 214 AND V2, V3
+            0x1206,  # 216 JP 0x206
+        ],
+        0x300: [
+            0x3C7E, 0xFFDB, 0xFFFF, 0xC3E7, 0x7E3C, 0x1818, 0x3C66, 0xC300,
+        ],
+    }),
+    'memory': ('FX33, FX55, FX65 and FX1E memory operations', {
+        0x200: [
+            0x6E00,  # 200 LD VE, 0x00
+            0xA400,  # 202 LD I, 0x400
+            0xFE33,  # 204 LD B, VE
+            0xF265,  # 206 LD V2, [I]
+            0xA410,  # 208 LD I, 0x410
+            0xFE55,  # 20A LD [I], VE
+            0xA410,  # 20C LD I, 0x410
+            0xFD65,  # 20E LD VD, [I]
+            0xF01E,  # 210 ADD I, V0
+            0x7E01,  # 212 ADD VE, 0x01
+            0x1202,  # 214 JP 0x202
+        ],
+    }),
+    'calls': ('2NNN calls and 00EE returns, three levels deep', {
+        0x200: [
+            0x2300,  # 200 CALL 0x300
+            0x1200,  # 202 JP 0x200
+        ],
+        0x300: [
+            0x2310,  # 300 CALL 0x310
+            0x2310,  # 302 CALL 0x310
+            0x00EE,  # 304 RET
+        ],
+        0x310: [
+            0x2320,  # 310 CALL 0x320
+            0x7001,  # 312 ADD V0, 0x01
+            0x00EE,  # 314 RET
+        ],
+        0x320: [
+            0x7101,  # 320 ADD V1, 0x01
+            0x00EE,  # 322 RET
+        ],
+    }),
+    'cls': ('00E0 display clears between small sprites', {
+        0x200: [
+            0x6000,  # 200 LD V0, 0x00
+            0x00E0,  # 202 CLS
+            0xF029,  # 204 LD F, V0
+            0xD115,  # 206 DRW V1, V1, 0x5
+            0x7101,  # 208 ADD V1, 0x01
+            0x00E0,  # 20A CLS
+            0x1202,  # 20C JP 0x202
+        ],
+    }),
+    'branches': ('3XNN, 4XNN, 5XY0 and 9XY0 skips', {
+        0x200: [
+            0x6000,  # 200 LD V0, 0x00
+            0x6100,  # 202 LD V1, 0x00
+            0x7001,  # 204 ADD V0, 0x01
+            0x3005,  # 206 SE V0, 0x05
+            0x4010,  # 208 SNE V0, 0x10
+            0x5010,  # 20A SE V0, V1
+            0x9010,  # 20C SNE V0, V1
+            0x7101,  # 20E ADD V1, 0x01
+            0x1204,  # 210 JP 0x204
+        ],
+    }),
+}
+
+
+def assemble(sections):
+    """
+    Return the program bytes of {address: opcodes} sections, loaded at 0x200
+    """
+    end = max(addr + 2 * len(opcodes) for addr, opcodes in sections.items())
+    program = bytearray(end - 0x200)
+    for addr, opcodes in sections.items():
+        offset = addr - 0x200
+        program[offset:offset + 2 * len(opcodes)] = struct.pack(
+            '>{}H'.format(len(opcodes)), *opcodes)
+    return bytes(program)
+
+
+def rom_path(name):
+    return os.path.join(ROMS_DIRECTORY, name + '.ch8')
+
+
+def main():
+    os.makedirs(ROMS_DIRECTORY, exist_ok=True)
+    for name, (_, sections) in sorted(ROMS.items()):
+        with open(rom_path(name), 'wb') as rom_file:
+            rom_file.write(assemble(sections))
+
+if __name__ == '__main__':
+    main()
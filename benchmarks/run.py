@@ -0,0 +1,259 @@
+"""
+Headless throughput benchmarks.
+
+Runs every benchmark program on each execution engine, measuring
+instructions and frames per second, then times each instruction handler of
+the interpreter. Results are written as JSON and compared with a baseline
+saved by an earlier run:
+
+    python3 -m benchmarks.run --save-baseline benchmarks/baseline.json
+    python3 -m benchmarks.run --baseline benchmarks/baseline.json
+"""
+import argparse
+import json
+import platform
+import sys
+import time
+
+from lib.batch import create_vm
+from lib.compiler import ENGINES
+from benchmarks.roms import ROMS, rom_path
+
+DEFAULT_CYCLES = 500 * 1000
+DEFAULT_REPEAT = 3
+DEFAULT_TOLERANCE = 0.1
+OPCODE_ITERATIONS = 50 * 1000
+
+# Handler name -> opcode exercising it, run at 0x200 with I at OPCODE_I
+OPCODES = {
+    'clear_display': 0x00E0,
+    'return_from_subroutine': 0x00EE,
+    'jump': 0x1300,
+    'call': 0x2300,
+    'skip_if_equal': 0x3000,
+    'skip_if_not_equal': 0x4000,
+    'skip_if_registers_equal': 0x5010,
+    'load': 0x6012,
+    'add': 0x7012,
+    'load_register': 0x8010,
+    'or_registers': 0x8011,
+    'and_registers': 0x8012,
+    'xor_registers': 0x8013,
+    'add_registers': 0x8014,
+    'sub_registers': 0x8015,
+    'shift_right': 0x8016,
+    'subn_registers': 0x8017,
+    'shift_left': 0x801E,
+    'skip_if_registers_not_equal': 0x9010,
+    'load_i': 0xA300,
+    'jump_v0': 0xB300,
+    'random': 0xC0FF,
+    'display': 0xD01F,
+    'skip_if_key': 0xE09E,
+    'skip_if_not_key': 0xE0A1,
+    'load_delay_timer': 0xF007,
+    'wait_key': 0xF00A,
+    'set_delay_timer': 0xF015,
+    'set_sound_timer': 0xF018,
+    'add_i': 0xF01E,
+    'load_font': 0xF029,
+    'store_bcd': 0xF033,
+    'store_registers': 0xFF55,
+    'load_registers': 0xFF65,
+}
+OPCODE_I = 0x400
+
+
+def run_rom(name, engine, cycles, repeat):
+    """
+    Return the best instructions and frames per second of repeat runs of
+    cycles instructions
+    """
+    best = None
+    for _ in range(repeat):
+        vm = create_vm(engine=ENGINES[engine])
+        vm.load(rom_path(name))
+
+        start_time = time.perf_counter()
+        vm.start(max_cycles=cycles)
+        elapsed = time.perf_counter() - start_time
+
+        if best is None or elapsed < best[0]:
+            best = elapsed, vm.cycles, vm.frames
+
+    elapsed, executed, frames = best
+    return {
+        'instructions_per_second': executed / elapsed,
+        'frames_per_second': frames / elapsed,
+    }
+
+
+def time_opcode(opcode, iterations):
+    """
+    Return the nanoseconds spent by the interpreter on one step of opcode,
+    including the cost of resetting PC, SP and I around it
+    """
+    vm = create_vm()
+    vm.memory[0x200] = opcode >> 8
+    vm.memory[0x201] = opcode & 0xFF
+    vm.invalidate_code(0x200, 0x202)
+    step = vm.processor.step
+
+    start_time = time.perf_counter()
+    for _ in range(iterations):
+        vm.pc = 0x200
+        vm.sp = 1
+        vm.i_register = OPCODE_I
+        vm.key_register = None
+        step()
+    elapsed = time.perf_counter() - start_time
+
+    return elapsed / iterations * 1e9
+
+
+def run_opcodes(iterations, repeat):
+    costs = {}
+    for name, opcode in sorted(OPCODES.items()):
+        costs[name] = min(time_opcode(opcode, iterations)
+                          for _ in range(repeat))
+    return costs
+
+
+def run(engines, cycles, repeat):
+    results = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cycles': cycles,
+        'roms': {},
+    }
+
+    for engine in engines:
+        results['roms'][engine] = dict(
+            (name, run_rom(name, engine, cycles, repeat))
+            for name in sorted(ROMS))
+
+    results['opcodes_ns'] = run_opcodes(OPCODE_ITERATIONS, repeat)
+    return results
+
+
+def confirm_regressions(results, baseline, tolerance, repeat):
+    """
+    Measure again the programs slower than baseline beyond tolerance,
+    keeping their best results, so that a single noisy run does not fail
+    """
+    for engine, roms in results['roms'].items():
+        for name, metrics in roms.items():
+            expected = baseline['roms'].get(engine, {}).get(name)
+            if expected is None:
+                continue
+            speed = metrics['instructions_per_second']
+            if speed >= (1 - tolerance) * expected['instructions_per_second']:
+                continue
+            again = run_rom(name, engine, results['cycles'], repeat)
+            if again['instructions_per_second'] > speed:
+                roms[name] = again
+
+
+def compare(results, baseline, tolerance):
+    """
+    Return (description, baseline, current, ratio, gated) rows and the
+    number of program throughput regressions beyond tolerance. Frame rates
+    follow instruction rates and opcode costs are only reported, single
+    steps being too short to time steadily.
+    """
+    rows = []
+    regressions = 0
+
+    for engine, roms in sorted(results['roms'].items()):
+        for name, metrics in sorted(roms.items()):
+            try:
+                expected = baseline['roms'][engine][name]
+            except KeyError:
+                continue
+            for metric, value in sorted(metrics.items()):
+                ratio = value / expected[metric]
+                gated = metric == 'instructions_per_second'
+                if gated and ratio < 1 - tolerance:
+                    regressions += 1
+                rows.append(('{} {} {}'.format(engine, name, metric),
+                             expected[metric], value, ratio, gated))
+
+    for name, cost in sorted(results['opcodes_ns'].items()):
+        expected = baseline.get('opcodes_ns', {}).get(name)
+        if expected is None:
+            continue
+        # Costs regress when they grow, so compare speeds
+        rows.append(('opcode {} ns'.format(name), expected, cost,
+                     expected / cost, False))
+
+    return rows, regressions
+
+
+def print_results(results, output):
+    for engine, roms in sorted(results['roms'].items()):
+        for name, metrics in sorted(roms.items()):
+            output.write('{:<12} {:<9} {:>12.0f} instructions/s {:>8.1f} '
+                         'frames/s\n'.format(
+                             engine, name,
+                             metrics['instructions_per_second'],
+                             metrics['frames_per_second']))
+
+    for name, cost in sorted(results['opcodes_ns'].items(),
+                             key=lambda item: -item[1]):
+        output.write('{:<28} {:>8.0f} ns\n'.format(name, cost))
+
+
+def main(args):
+    results = run(args.engines, args.cycles, args.repeat)
+    print_results(results, sys.stderr)
+
+    if args.output == '-':
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    elif args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as output:
+            json.dump(results, output, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+
+        confirm_regressions(results, baseline, args.tolerance, args.repeat)
+        rows, regressions = compare(results, baseline, args.tolerance)
+        for description, expected, value, ratio, gated in rows:
+            sys.stderr.write('{:<50} {:>12.1f} {:>12.1f} {:>6.2f}{}\n'.format(
+                description, expected, value, ratio,
+                ' REGRESSION' if gated and ratio < 1 - args.tolerance
+                else ''))
+
+        if regressions:
+            sys.exit('{} throughput regressions beyond {:.0%}'.format(
+                regressions, args.tolerance))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Measure headless CHIP-8 throughput')
+
+    parser.add_argument('-e', '--engines', nargs='+', default=list(ENGINES),
+                        choices=ENGINES, help='execution engines to measure')
+    parser.add_argument('-c', '--cycles', type=int, default=DEFAULT_CYCLES,
+                        help='instructions per benchmark program run')
+    parser.add_argument('-r', '--repeat', type=int, default=DEFAULT_REPEAT,
+                        help='runs per measure, the best one is kept')
+    parser.add_argument('-o', '--output', type=str,
+                        help='results JSON file, - for stdout')
+    parser.add_argument('-b', '--baseline', type=str,
+                        help='baseline JSON file to compare results with,\
+                         exiting with an error on regressions')
+    parser.add_argument('-sb', '--save-baseline', type=str,
+                        help='save results as the SAVE_BASELINE baseline')
+    parser.add_argument('-t', '--tolerance', type=float,
+                        default=DEFAULT_TOLERANCE,
+                        help='allowed program throughput loss ratio\
+                         (defaults to 0.1)')
+
+    main(parser.parse_args())
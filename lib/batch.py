@@ -0,0 +1,190 @@
+"""
+Headless batch runner: runs a corpus of CHIP-8 programs across a pool of
+worker processes and reports the final state of each.
+
+    python3 -m lib.batch [options] ROMS...
+
+ROMS are .ch8 files, directories searched for .ch8 files, or manifests
+listing one program path per line.
+"""
+import argparse
+import csv
+import hashlib
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+from lib import chip8, headless
+from lib.compiler import ENGINES
+
+REPORT_FIELDS = ('rom', 'error', 'blocked', 'cycles', 'frames', 'elapsed',
+                 'cycles_per_second', 'display_hash', 'registers',
+                 'i_register', 'pc', 'sp', 'dt', 'st')
+DEFAULT_TIMEOUT = 300  # Seconds per program
+
+
+def find_roms(paths):
+    """
+    Expand directories and manifests to the list of programs they hold
+    """
+    roms = []
+    for path in paths:
+        if os.path.isdir(path):
+            for directory, _, file_names in sorted(os.walk(path)):
+                roms.extend(os.path.join(directory, file_name)
+                            for file_name in sorted(file_names)
+                            if file_name.lower().endswith('.ch8'))
+        elif path.lower().endswith('.ch8'):
+            roms.append(path)
+        else:
+            base = os.path.dirname(path)
+            with open(path) as manifest:
+                for line in manifest:
+                    line = line.strip()
+                    if line and not line.startswith('#'):
+                        roms.append(os.path.join(base, line))
+    return roms
+
+
+def display_hash(vm):
+    return hashlib.sha1(b''.join(
+        row.to_bytes(chip8.DISPLAY_WIDTH // 8, 'big')
+        for row in vm.display_rows)).hexdigest()
+
+
+def create_vm(frequency=chip8.CLOCK_FREQUENCY, engine=None, script=(),
+              keyboard=None):
+    """
+    Create a headless VM, key presses being played from script unless
+    another keyboard is given
+    """
+    ev = headless.VirtualClock(frequency)
+    kb = headless.ScriptedKeyboard(ev, script) if keyboard is None else \
+        keyboard
+    ev.set_keyboard(kb)
+    rd = headless.NullRenderer(chip8.DISPLAY_WIDTH, chip8.DISPLAY_HEIGHT)
+    vm = chip8.Chip8(ev, kb, rd, engine)
+    vm.set_debug(False)
+    return vm
+
+
+def run_rom(job):
+    """
+    Run a program within its budget and return its report entry. Programs
+    still running after timeout seconds are stopped with an error.
+    """
+    rom, cycles, frames, frequency, engine_name, timeout = job
+
+    vm = create_vm(frequency, ENGINES[engine_name])
+    result = {'rom': rom, 'error': None}
+
+    start_time = time.perf_counter()
+    if timeout:
+        vm.event_loop.deadline = start_time + timeout
+    try:
+        vm.load(rom)
+        vm.start(cycles, frames)
+    except Exception as e:
+        result['error'] = '{}: {}'.format(type(e).__name__, e)
+    elapsed = time.perf_counter() - start_time
+
+    result.update({
+        'blocked': vm.blocked,
+        'cycles': vm.cycles,
+        'frames': vm.frames,
+        'elapsed': elapsed,
+        'cycles_per_second': vm.cycles / elapsed if elapsed else 0,
+        'display_hash': display_hash(vm),
+        'registers': list(vm.v_registers),
+        'i_register': vm.i_register,
+        'pc': vm.pc,
+        'sp': vm.sp,
+        'dt': vm.dt,
+        'st': vm.st,
+    })
+    return result
+
+
+def run_batch(roms, cycles=None, frames=None,
+              frequency=chip8.CLOCK_FREQUENCY, engine='interpreter',
+              processes=None, timeout=DEFAULT_TIMEOUT):
+    """
+    Run roms on a pool of processes, returning reports in roms order
+    """
+    jobs = [(rom, cycles, frames, frequency, engine, timeout)
+            for rom in roms]
+    with multiprocessing.Pool(processes) as pool:
+        return pool.map(run_rom, jobs, chunksize=1)
+
+
+def write_report(results, output, report_format):
+    if report_format == 'csv':
+        writer = csv.DictWriter(output, REPORT_FIELDS)
+        writer.writeheader()
+        for result in results:
+            row = dict(result)
+            row['registers'] = ' '.join(
+                '{:02X}'.format(r) for r in result['registers'])
+            writer.writerow(row)
+    else:
+        json.dump(results, output, indent=2)
+        output.write('\n')
+
+
+def main(args):
+    if args.cycles is None and args.frames is None:
+        sys.exit('A --cycles or --frames budget is required')
+
+    roms = find_roms(args.roms)
+
+    start_time = time.perf_counter()
+    results = run_batch(roms, args.cycles, args.frames,
+                        args.frequency or chip8.CLOCK_FREQUENCY,
+                        args.engine, args.processes, args.timeout)
+    elapsed = time.perf_counter() - start_time
+
+    report_format = args.format
+    if report_format is None:
+        report_format = 'csv' if args.output.endswith('.csv') else 'json'
+
+    if args.output == '-':
+        write_report(results, sys.stdout, report_format)
+    else:
+        with open(args.output, 'w', newline='') as output:
+            write_report(results, output, report_format)
+
+    errors = sum(1 for result in results if result['error'])
+    blocked = sum(1 for result in results if result['blocked'])
+    sys.stderr.write('Ran {} programs in {:.2f}s, {} errors, {} blocked on a '
+                     'key\n'.format(len(results), elapsed, errors, blocked))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Run CHIP-8 programs headlessly across processes')
+
+    parser.add_argument('roms', type=str, nargs='+',
+                        help='.ch8 files, directories or manifests')
+    parser.add_argument('-c', '--cycles', type=int,
+                        help='stop each program after CYCLES instructions')
+    parser.add_argument('-f', '--frames', type=int,
+                        help='stop each program after FRAMES 60Hz frames')
+    parser.add_argument('-fr', '--frequency', type=float,
+                        help='CHIP-8 VM clock frequency (defaults to 1.76Mhz)')
+    parser.add_argument('-e', '--engine', default='interpreter',
+                        choices=ENGINES,
+                        help='execution engine')
+    parser.add_argument('-p', '--processes', type=int,
+                        help='worker processes (defaults to CPU count)')
+    parser.add_argument('-to', '--timeout', type=float,
+                        default=DEFAULT_TIMEOUT,
+                        help='stop each program still running after TIMEOUT\
+                         seconds with an error, 0 for no limit (defaults to\
+                         300)')
+    parser.add_argument('-o', '--output', type=str, default='-',
+                        help='report file, .json or .csv (defaults to stdout)')
+    parser.add_argument('--format', choices=('json', 'csv'),
+                        help='report format (defaults to output extension)')
+
+    main(parser.parse_args())
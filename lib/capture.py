@@ -0,0 +1,358 @@
+"""
+Display capture: records every frame the VM draws into a compact file from
+a writer thread, and converts recordings to PNG sequences or animated GIFs.
+
+Recordings are a header followed by a zlib stream of records, one per frame
+whose display changed. A record holds the number of frames since the
+previous record as a varint, a 32-bit mask of the rows which changed, then
+for each of these rows a mask of its changed bytes followed by those bytes
+XORed with their previous value. A record without changed rows ends the
+recording, its frame count giving the session length. Recordings are made
+with pychip8.py --capture and converted with:
+
+    python3 -m lib.capture recording.c8v output.gif
+    python3 -m lib.capture recording.c8v output_directory
+"""
+import argparse
+import os
+import queue
+import struct
+import threading
+import zlib
+
+from lib.chip8 import DISPLAY_WIDTH, DISPLAY_HEIGHT, TIMERS_UPDATE_FREQUENCY
+
+MAGIC = b'C8CV'
+VERSION = 1
+HEADER = struct.Struct('>4sBBB')  # magic, version, width, height
+ROWS_MASK = struct.Struct('>I')
+ROW_BYTES = DISPLAY_WIDTH // 8
+COMPRESSION_LEVEL = 6
+DEFAULT_SCALE = 4
+
+BLANK_ROWS = (0,) * DISPLAY_HEIGHT
+
+
+class InvalidCapture(Exception):
+    pass
+
+
+def encode_varint(value):
+    data = bytearray()
+    while value >= 0x80:
+        data.append(value & 0x7F | 0x80)
+        value >>= 7
+    data.append(value)
+    return bytes(data)
+
+
+def decode_varint(data, offset):
+    """
+    Return the varint at offset and the offset following it
+    """
+    value = 0
+    shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, offset
+
+
+def encode_record(frames, previous, rows):
+    """
+    Return the record of rows drawn frames after the previous ones
+    """
+    mask = 0
+    changes = []
+    for row, (pixels, last) in enumerate(zip(rows, previous)):
+        delta = pixels ^ last
+        if not delta:
+            continue
+        mask |= 1 << row
+
+        byte_mask = 0
+        data = bytearray()
+        for index, byte in enumerate(delta.to_bytes(ROW_BYTES, 'big')):
+            if byte:
+                byte_mask |= 0x80 >> index
+                data.append(byte)
+        changes.append(bytes((byte_mask,)) + data)
+
+    return encode_varint(frames) + ROWS_MASK.pack(mask) + b''.join(changes)
+
+
+class Capture(object):
+    """
+    Writes the frames submitted by the VM to output. Records are encoded and
+    compressed on a writer thread, the VM only queueing a copy of the rows.
+    """
+
+    def __init__(self, output):
+        self.output = output
+        self.queue = queue.SimpleQueue()
+
+        output.write(HEADER.pack(MAGIC, VERSION, DISPLAY_WIDTH,
+                                 DISPLAY_HEIGHT))
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, frame, rows):
+        """
+        Queue the display rows drawn at frame, called on display refreshes
+        """
+        self.queue.put((frame, tuple(rows)))
+
+    def run(self):
+        compressor = zlib.compressobj(COMPRESSION_LEVEL)
+        previous = BLANK_ROWS
+        last_frame = None
+
+        while True:
+            frame, rows = self.queue.get()
+            if last_frame is None:
+                # Frames count from the first one submitted
+                last_frame = frame
+                frames = 0
+            else:
+                # Frames go back while rewinding, they are recorded as
+                # following ones
+                frames = max(frame - last_frame, 1)
+
+            if rows is None:
+                # End marker
+                self.output.write(compressor.compress(
+                    encode_record(frames, previous, previous)))
+                break
+            if rows == previous:
+                continue
+
+            self.output.write(compressor.compress(
+                encode_record(frames, previous, rows)))
+            previous = rows
+            last_frame = frame
+
+        self.output.write(compressor.flush())
+
+    def close(self, frame):
+        """
+        End the recording at frame and wait for the writer thread
+        """
+        self.queue.put((frame, None))
+        self.thread.join()
+        self.output.flush()
+
+
+def read_capture(capture_file):
+    """
+    Yield the (frame, rows) of every recorded frame, frame counting from the
+    first one, then (frame, None) at the end of the recording
+    """
+    header = capture_file.read(HEADER.size)
+    if len(header) < HEADER.size:
+        raise InvalidCapture('Truncated capture header')
+
+    magic, version, width, height = HEADER.unpack(header)
+    if magic != MAGIC or version != VERSION:
+        raise InvalidCapture('Unsupported capture format')
+
+    # Interrupted recordings are read up to their last complete record
+    data = zlib.decompressobj().decompress(capture_file.read())
+    rows = [0] * height
+    row_bytes = width // 8
+    frame = 0
+    offset = 0
+
+    try:
+        while offset < len(data):
+            frames, offset = decode_varint(data, offset)
+            mask, = ROWS_MASK.unpack_from(data, offset)
+            offset += ROWS_MASK.size
+            frame += frames
+
+            if not mask:
+                yield frame, None
+                return
+
+            for row in range(height):
+                if not mask & (1 << row):
+                    continue
+                byte_mask = data[offset]
+                offset += 1
+                delta = bytearray(row_bytes)
+                for index in range(row_bytes):
+                    if byte_mask & (0x80 >> index):
+                        delta[index] = data[offset]
+                        offset += 1
+                rows[row] ^= int.from_bytes(delta, 'big')
+
+            yield frame, tuple(rows)
+    except (IndexError, struct.error):
+        pass
+
+    yield frame, None
+
+
+def scale_rows(rows, width, scale):
+    """
+    Return the lines of rows scaled up, as strings of '0' and '1' pixels
+    """
+    lines = []
+    for pixels in rows:
+        line = ''.join(bit * scale for bit in '{:0{}b}'.format(pixels, width))
+        lines.extend([line] * scale)
+    return lines
+
+
+def png_chunk(tag, data):
+    return struct.pack('>I', len(data)) + tag + data + \
+        struct.pack('>I', zlib.crc32(tag + data))
+
+
+def encode_png(rows, width, scale):
+    """
+    Return a 1-bit grayscale PNG image of rows
+    """
+    lines = scale_rows(rows, width, scale)
+    row_size = (len(lines[0]) + 7) // 8
+    image = b''.join(
+        b'\x00' + int(line, 2).to_bytes(row_size, 'big')
+        for line in (line.ljust(row_size * 8, '0') for line in lines))
+
+    return b'\x89PNG\r\n\x1a\n' + png_chunk(b'IHDR', struct.pack(
+        '>IIBBBBB', len(lines[0]), len(lines), 1, 0, 0, 0, 0)) + \
+        png_chunk(b'IDAT', zlib.compress(image)) + png_chunk(b'IEND', b'')
+
+
+def lzw_encode(pixels, min_code_size=2):
+    """
+    Return the GIF LZW compressed data of pixels, a bytes-like object of
+    color indices
+    """
+    clear_code = 1 << min_code_size
+    end_code = clear_code + 1
+    output = bytearray()
+    bits = 0
+    bit_count = 0
+
+    def reset():
+        return dict((bytes((index,)), index)
+                    for index in range(clear_code)), end_code + 1, \
+            min_code_size + 1
+
+    def emit(code, size):
+        nonlocal bits, bit_count
+        bits |= code << bit_count
+        bit_count += size
+        while bit_count >= 8:
+            output.append(bits & 0xFF)
+            bits >>= 8
+            bit_count -= 8
+
+    table, next_code, code_size = reset()
+    emit(clear_code, code_size)
+
+    prefix = bytes(pixels[:1])
+    for index in range(1, len(pixels)):
+        candidate = prefix + pixels[index:index + 1]
+        if candidate in table:
+            prefix = candidate
+            continue
+
+        emit(table[prefix], code_size)
+        if next_code < 0x1000:
+            table[candidate] = next_code
+            next_code += 1
+            # Decoders widen codes as soon as the table fills them
+            if next_code > 1 << code_size:
+                code_size += 1
+        else:
+            emit(clear_code, code_size)
+            table, next_code, code_size = reset()
+        prefix = bytes(pixels[index:index + 1])
+
+    emit(table[prefix], code_size)
+    emit(end_code, code_size)
+    if bit_count:
+        output.append(bits & 0xFF)
+    return bytes(output)
+
+
+def encode_gif(frames, width, scale):
+    """
+    Return an animated GIF of (rows, 60Hz frames shown) frames, looping
+    forever
+    """
+    scaled_width = width * scale
+    data = bytearray(b'GIF89a')
+    data += struct.pack('<HHBBB', scaled_width, 0, 0x80, 0, 0)
+    data += b'\x00\x00\x00\xff\xff\xff'  # Black and white palette
+    data += b'\x21\xff\x0bNETSCAPE2.0\x03\x01\x00\x00\x00'  # Loop
+    height = None
+
+    for rows, duration in frames:
+        lines = scale_rows(rows, width, scale)
+        height = len(lines)
+        # GIF delays are in hundredths of a second
+        delay = max(round(duration * 100 / TIMERS_UPDATE_FREQUENCY), 1)
+        data += struct.pack('<BBBBHBB', 0x21, 0xF9, 4, 0, delay, 0, 0)
+        data += struct.pack('<BHHHHB', 0x2C, 0, 0, scaled_width, height, 0)
+
+        pixels = ''.join(lines).encode().translate(bytes.maketrans(
+            b'01', b'\x00\x01'))
+        compressed = lzw_encode(pixels)
+        data.append(2)  # LZW minimum code size
+        for start in range(0, len(compressed), 0xFF):
+            block = compressed[start:start + 0xFF]
+            data.append(len(block))
+            data += block
+        data.append(0)
+
+    data.append(0x3B)
+    # The logical screen height is only known once a frame is scaled
+    struct.pack_into('<H', data, 8, height or DISPLAY_HEIGHT * scale)
+    return bytes(data)
+
+
+def convert(capture_file, output, scale=DEFAULT_SCALE):
+    """
+    Convert a recording to an animated GIF if output ends with .gif, to a
+    directory of frame_NNNNNN.png images named after their frame otherwise
+    """
+    records = list(read_capture(capture_file))
+    width = DISPLAY_WIDTH
+
+    if output.lower().endswith('.gif'):
+        frames = [(rows, next_frame - frame) for (frame, rows), (next_frame, _)
+                  in zip(records, records[1:])]
+        with open(output, 'wb') as gif_file:
+            gif_file.write(encode_gif(frames, width, scale))
+        return
+
+    os.makedirs(output, exist_ok=True)
+    for frame, rows in records:
+        if rows is None:
+            continue
+        path = os.path.join(output, 'frame_{:06d}.png'.format(frame))
+        with open(path, 'wb') as png_file:
+            png_file.write(encode_png(rows, width, scale))
+
+
+def main(args):
+    with open(args.capture, 'rb') as capture_file:
+        convert(capture_file, args.output, args.scale)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Convert a CHIP-8 display capture to images')
+
+    parser.add_argument('capture', type=str,
+                        help='capture file recorded with pychip8.py --capture')
+    parser.add_argument('output', type=str,
+                        help='animated .gif file, or directory of PNG images')
+    parser.add_argument('-s', '--scale', type=int, default=DEFAULT_SCALE,
+                        help='pixels per display cell (defaults to 4)')
+
+    main(parser.parse_args())
@@ -1,8 +1,12 @@
 from array import array
-from random import randint
+from functools import partial
 import logging
+import random
 import sys
 
+from lib.presenter import Presenter, rows_to_pixels
+from lib import snapshot
+
 HEX_CHARS = [
     0xF0, 0x90, 0x90, 0x90, 0xF0,  # 0
     0x20, 0x60, 0x20, 0x20, 0x70,  # 1
@@ -24,341 +28,404 @@ HEX_CHARS = [
 
 DISPLAY_WIDTH = 64
 DISPLAY_HEIGHT = 32
+DISPLAY_ROW_MASK = (1 << DISPLAY_WIDTH) - 1
 HEX_SPRITE_SIZE = 5
+MEMORY_SIZE = 0xFFF + 1
+PROGRAM_START = 0x200
+PROGRAM_MAX_SIZE = MEMORY_SIZE - PROGRAM_START
+MAX_DIRTY_RECTS = 64
+# Memory is compared page by page on restore, to only invalidate code in
+# pages which changed
+MEMORY_PAGE_SIZE = 0x100
 
 CLOCK_FREQUENCY = 1760*1000  # 1.76Mhz, as COSMAC V
 TIMERS_UPDATE_FREQUENCY = 60  # 60 Hz
 
+# Instructions only reading registers, memory, keys and the delay timer, and
+# only writing registers and I. A loop of them which comes back to its start
+# with the same registers runs the same until keys and timers change, at the
+# next frame.
+IDLE_INSTRUCTIONS = {
+    'jump', 'jump_v0', 'skip_if_equal', 'skip_if_not_equal',
+    'skip_if_registers_equal', 'skip_if_registers_not_equal', 'skip_if_key',
+    'skip_if_not_key', 'load', 'add', 'load_register', 'or_registers',
+    'and_registers', 'xor_registers', 'add_registers', 'sub_registers',
+    'shift_right', 'subn_registers', 'shift_left', 'load_i', 'add_i',
+    'load_font', 'load_delay_timer', 'load_registers'
+}
+MAX_IDLE_LOOP_LENGTH = 16
+# Instructions between two idle loop checks, doubled after each check which
+# found none within a frame
+IDLE_CHECK_INTERVAL = 1024
+
+
+# Mask isolating the opcode identifier, indexed by the opcode top nibble
+SUB_OPCODE_MASKS = (
+    0xFFFF, 0xF000, 0xF000, 0xF000, 0xF000, 0xF00F, 0xF000, 0xF000,
+    0xF00F, 0xF00F, 0xF000, 0xF000, 0xF000, 0xF000, 0xF0FF, 0xF0FF
+)
+
+
+def no_operands(opcode):
+    return ()
+
+
+def operands_nnn(opcode):
+    return (opcode & 0x0FFF,)
+
+
+def operands_x(opcode):
+    return ((opcode & 0x0F00) >> 8,)
+
+
+def operands_x_nn(opcode):
+    return ((opcode & 0x0F00) >> 8, opcode & 0x00FF)
+
+
+def operands_x_y(opcode):
+    return ((opcode & 0x0F00) >> 8, (opcode & 0x00F0) >> 4)
+
+
+def operands_x_y_n(opcode):
+    return ((opcode & 0x0F00) >> 8, (opcode & 0x00F0) >> 4, opcode & 0x000F)
+
+
+class Random(object):
+    """
+    Xorshift32 generator for CXNN. Its state is a single integer saved in
+    snapshots, and its sequence does not depend on the Python version, so
+    that seeded runs are reproducible anywhere.
+    """
+
+    def __init__(self, seed=None):
+        self.state = None
+        self.seed(seed)
+
+    def seed(self, seed=None):
+        if seed is None:
+            seed = random.getrandbits(32)
+        # Xorshift never leaves a zero state
+        self.state = (seed & 0xFFFFFFFF) or 1
+
+    def randbyte(self):
+        x = self.state
+        x ^= (x << 13) & 0xFFFFFFFF
+        x ^= x >> 17
+        x ^= (x << 5) & 0xFFFFFFFF
+        self.state = x
+        # High bits are the most random ones
+        return x >> 24
+
 
 class UnsupportedOpCode(Exception):
     pass
 
 
+class InvalidProgram(Exception):
+    pass
+
+
 class Processor(object):
     """
     Executes OPCODES in a CHIP-8 VM
     """
 
+    # Opcode identifier -> (handler name, operands decoder)
+    INSTRUCTIONS = {
+        0x00E0: ('clear_display', no_operands),
+        0x00EE: ('return_from_subroutine', no_operands),
+        0x1000: ('jump', operands_nnn),
+        0x2000: ('call', operands_nnn),
+        0x3000: ('skip_if_equal', operands_x_nn),
+        0x4000: ('skip_if_not_equal', operands_x_nn),
+        0x5000: ('skip_if_registers_equal', operands_x_y),
+        0x6000: ('load', operands_x_nn),
+        0x7000: ('add', operands_x_nn),
+        0x8000: ('load_register', operands_x_y),
+        0x8001: ('or_registers', operands_x_y),
+        0x8002: ('and_registers', operands_x_y),
+        0x8003: ('xor_registers', operands_x_y),
+        0x8004: ('add_registers', operands_x_y),
+        0x8005: ('sub_registers', operands_x_y),
+        0x8006: ('shift_right', operands_x_y),
+        0x8007: ('subn_registers', operands_x_y),
+        0x800E: ('shift_left', operands_x_y),
+        0x9000: ('skip_if_registers_not_equal', operands_x_y),
+        0xA000: ('load_i', operands_nnn),
+        0xB000: ('jump_v0', operands_nnn),
+        0xC000: ('random', operands_x_nn),
+        0xD000: ('display', operands_x_y_n),
+        0xE09E: ('skip_if_key', operands_x),
+        0xE0A1: ('skip_if_not_key', operands_x),
+        0xF007: ('load_delay_timer', operands_x),
+        0xF00A: ('wait_key', operands_x),
+        0xF015: ('set_delay_timer', operands_x),
+        0xF018: ('set_sound_timer', operands_x),
+        0xF01E: ('add_i', operands_x),
+        0xF029: ('load_font', operands_x),
+        0xF033: ('store_bcd', operands_x),
+        0xF055: ('store_registers', operands_x),
+        0xF065: ('load_registers', operands_x),
+    }
+
     def __init__(self, vm):
         self.vm = vm
+        # Opcode -> decoded instruction, filled as opcodes are met
+        self.instructions = {}
+        # Address -> decoded instruction, filled as instructions are fetched
+        self.decoded = [None] * len(vm.memory)
 
-    def run(self, opcode):
+    @classmethod
+    def identify(cls, opcode):
         """
-        Run OPCODE
+        Return OPCODE handler name and operands
         """
-
-        nibble = opcode & 0xF000
-        self.vm.pc += 2
-
-        if nibble == 0x0:
-            if opcode == 0x00E0:
-                return self.clear_display()
-            if opcode == 0x00EE:
-                return self.return_from_subroutine()
+        identifier = opcode & SUB_OPCODE_MASKS[opcode >> 12]
+        try:
+            name, operands = cls.INSTRUCTIONS[identifier]
+        except KeyError:
             raise UnsupportedOpCode(
                 'Unsupported "0x{:X}" opcode received'.format(opcode))
 
-        if nibble in (0x1000, 0xB000):
-            return self.jump(opcode)
+        return name, operands(opcode)
 
-        if nibble == 0x2000:
-            return self.call(opcode)
-
-        if nibble in (0x3000, 0x4000, 0x5000, 0x9000, 0xE000):
-            return self.skip(opcode)
-
-        if nibble in (0x6000, 0x7000, 0x8000, 0xA000, 0xC000, 0xF000):
-            return self.set_register(opcode)
+    def decode(self, opcode):
+        """
+        Bind OPCODE handler to its operands
+        """
+        name, operands = self.identify(opcode)
+        return partial(getattr(self, name), *operands)
 
-        if nibble == 0xD000:
-            return self.display(opcode)
+    def step(self, limit=1):
+        """
+        Fetch and run the instruction at PC. Returns the number of
+        instructions executed, for compatibility with the other engines.
+        """
+        vm = self.vm
+        pc = vm.pc
+        instruction = self.decoded[pc]
+
+        if instruction is None:
+            opcode = vm.memory[pc] << 8 | vm.memory[pc + 1]
+            try:
+                instruction = self.instructions[opcode]
+            except KeyError:
+                instruction = self.instructions[opcode] = self.decode(opcode)
+            self.decoded[pc] = instruction
+
+        vm.pc = pc + 2
+        instruction()
+        return 1
+
+    def invalidate(self, start, end):
+        """
+        Drop decoded instructions overlapping the [start, end[ memory range
+        """
+        decoded = self.decoded
+        for addr in range(max(start - 1, 0), min(end, len(decoded))):
+            decoded[addr] = None
 
     def clear_display(self):
-        self.vm.logger.debug('CLS')
         self.vm.reset_display()
 
     def return_from_subroutine(self):
-        self.vm.logger.debug('RTN 0x{:X}'.format(self.vm.sp))
         self.vm.sp -= 1
         assert (self.vm.sp >= 0)
         self.vm.pc = self.vm.stack[self.vm.sp]
 
-    def jump(self, opcode):
-
-        jump_addr = None
-
-        # SYS
-        if opcode & 0xF000 == 0x1000:
-            jump_addr = opcode & 0x0FFF
-            assert (jump_addr >= 0x200)
-
-        # JP V0
-        elif opcode & 0xF000 == 0xB000:
-            jump_addr = (opcode & 0x0FFF) + self.vm.v_registers[0x0]
-            assert (jump_addr >= 0x200)
-            assert (jump_addr <= 0xFFFF)
+    def jump(self, addr):
+        assert (addr >= 0x200)
+        self.vm.pc = addr
 
-        if jump_addr is not None:
-            self.vm.logger.debug('JMP 0x{:X}'.format(jump_addr))
-            self.vm.pc = jump_addr
-
-    def call(self, opcode):
-        subroutine_addr = opcode & 0x0FFF
-        self.vm.logger.debug('CALL 0x{:X}'.format(subroutine_addr))
+    def jump_v0(self, addr):
+        jump_addr = addr + self.vm.v_registers[0x0]
+        assert (jump_addr >= 0x200)
+        assert (jump_addr <= 0xFFFF)
+        self.vm.pc = jump_addr
 
+    def call(self, addr):
         self.vm.stack[self.vm.sp] = self.vm.pc
         self.vm.sp += 1
         assert (self.vm.sp <= 0xFF)
 
-        self.vm.pc = subroutine_addr
+        self.vm.pc = addr
 
-    def skip(self, opcode):
-        """
-        Instruction skips
-        """
+    # Instruction skips
+
+    def skip_if_equal(self, x, value):
+        if self.vm.v_registers[x] == value:
+            self.vm.pc += 2
 
+    def skip_if_not_equal(self, x, value):
+        if self.vm.v_registers[x] != value:
+            self.vm.pc += 2
+
+    def skip_if_registers_equal(self, x, y):
         registers = self.vm.v_registers
-        logger = self.vm.logger
-        x = (opcode & 0x0F00) >> 8
-        y = (opcode & 0x00F0) >> 4
-        skip = False
-
-        # SE Vx
-        if opcode & 0xF000 == 0x3000:
-            logger.debug('SE V0x{:X}'.format(x))
-            value = opcode & 0x00FF
-            if registers[x] == value:
-                skip = True
-
-        # SNE Vx
-        elif opcode & 0xF000 == 0x4000:
-            logger.debug('SNE V0x{:X}'.format(x))
-            value = opcode & 0x00FF
-            if registers[x] != value:
-                skip = True
-
-        # SE Vx,Vy
-        elif opcode & 0xF00F == 0x5000:
-            logger.debug('SE V0x{:X},V0x{:X}'.format(x, y))
-            if registers[x] == registers[y]:
-                skip = True
-
-        # SNE Vx,Vy
-        elif opcode & 0xF00F == 0x9000:
-            logger.debug('SNE V0x{:X},V0x{:X}'.format(x, y))
-            if registers[x] != registers[y]:
-                skip = True
-
-        # SKP Vx
-        elif opcode & 0xF0FF == 0xE09E:
-            logger.debug('SKP V0x{:X}'.format(x))
-            if self.vm.get_key_state() == registers[x]:
-                skip = True
-
-        # SKPN Vx
-        elif opcode & 0xF0FF == 0xE0A1:
-            logger.debug('SKPN V0x{:X}'.format(x))
-            if self.vm.get_key_state() != registers[x]:
-                skip = True
-
-        if skip:
+        if registers[x] == registers[y]:
             self.vm.pc += 2
-            assert (self.vm.pc <= 0xFFFF)
 
-    def set_register(self, opcode):
-        """
-        Register operations
-        """
+    def skip_if_registers_not_equal(self, x, y):
+        registers = self.vm.v_registers
+        if registers[x] != registers[y]:
+            self.vm.pc += 2
 
-        vm = self.vm
-        logger = self.vm.logger
+    def skip_if_key(self, x):
+        if self.vm.get_key_state() == self.vm.v_registers[x]:
+            self.vm.pc += 2
+
+    def skip_if_not_key(self, x):
+        if self.vm.get_key_state() != self.vm.v_registers[x]:
+            self.vm.pc += 2
+
+    # Register operations
+
+    def load(self, x, value):
+        self.vm.v_registers[x] = value
+
+    def add(self, x, value):
         registers = self.vm.v_registers
-        x = (opcode & 0x0F00) >> 8
-        y = (opcode & 0x00F0) >> 4
-
-        # LD Vx
-        if opcode & 0xf000 == 0x6000:
-            value = opcode & 0x00FF
-            logger.debug('LD V0x{:X}, 0x{:X}'.format(x, value))
-            registers[x] = value
-
-        # ADD Vx
-        elif opcode & 0xF000 == 0x7000:
-            value = opcode & 0x00FF
-            logger.debug('ADD V0x{:X}, 0x{:X}'.format(x, value))
-            registers[x] += value
-
-            if registers[x] > 0xFF:
-                registers[x] -= 0xFF + 1
-
-        elif opcode & 0xF000 == 0x8000:
-
-            # VF is reserved
-            assert(x < 0xF)
-            assert(y < 0xF)
-
-            # LD Vx,Vy
-            if opcode & 0xF == 0x0:
-                registers[x] = registers[y]
-                logger.debug('LD V0x{:X}, V0x{:X}'.format(x, y))
-
-            # OR Vx,Vy
-            elif opcode & 0xF == 0x1:
-                registers[x] |= registers[y]
-                logger.debug('OR V0x{:X}, V0x{:X}'.format(x, y))
-
-            # AND Vx,Vy
-            elif opcode & 0xF == 0x2:
-                registers[x] &= registers[y]
-                logger.debug('AND V0x{:X}, V0x{:X}'.format(x, y))
-
-            # XOR Vx, Vy
-            elif opcode & 0xF == 0x3:
-                registers[x] ^= registers[y]
-                logger.debug('XOR V0x{:X}, V0x{:X}'.format(x, y))
-
-            # ADD Vx, Vy
-            elif opcode & 0xF == 0x4:
-                registers[x] += registers[y]
-                registers[0xF] = int(registers[x] > 0xFF)
-
-                if registers[x] > 0xFF:
-                    registers[x] -= 0xFF + 1
-
-                logger.debug('ADD V0x{:X}, V0x{:X}'.format(x, y))
-
-            # SUB Vx, Vy
-            elif opcode & 0xF == 0x5:
-                registers[0xF] = int(registers[y] > registers[x])
-                val_x = registers[x]
-                val_x -= registers[y]
-
-                if val_x < 0:
-                    val_x += 0xFF + 1
-                registers[x] = val_x
-
-                logger.debug('SUB V0x{:X}, V0x{:X}'.format(x, y))
-
-            # SHR Vx {, Vy}
-            elif opcode & 0xF == 0x6:
-                registers[0xF] = int(registers[x] & 0x1 == 0x1)
-                registers[x] >>= 1
-                logger.debug('SHR V0x{:X}, V0x{:X}'.format(x, 0xF))
-
-            # SUBN Vx, Vy
-            elif opcode & 0xF == 0x7:
-                registers[0xF] = int(registers[x] > registers[y])
-                val_x = registers[y] - registers[x]
-
-                if val_x < 0:
-                    val_x += 0xFF + 1
-
-                registers[x] = val_x
-                logger.debug('SUB V0x{:X}, V0x{:X}'.format(x, y))
-
-            # SHL Vx {, Vy}
-            elif opcode & 0xF == 0xE:
-                registers[0xF] = int(registers[x] & 0x80 == 0x80)
-                registers[x] <<= 1
-                logger.debug('SHL V0x{:X}, V0x{:X}'.format(x, 0xF))
-
-        # LD I
-        elif opcode & 0xF000 == 0xA000:
-            value = opcode & 0x0FFF
-            vm.i_register = value
-            logger.debug('LD I, 0x{:X}'.format(value))
-
-        # RND Vx
-        elif opcode & 0xF000 == 0xC000:
-            r = randint(0x0, 0xFF)
-            registers[x] = r & (opcode & 0x00FF)
-            logger.debug('RND V0x{:X}'.format(x))
-
-        # LD Vx, DT
-        elif opcode & 0xF0FF == 0xF007:
-            registers[x] = vm.dt
-            logger.debug('LD V0x{:X}, DT'.format(x))
-
-        # LD Vx, K
-        elif opcode & 0xF0FF == 0xF00A:
-            def update_register(key):
-                nonlocal registers, vm
-                registers[x] = key
-                vm.is_expecting_key = False
-                logger.debug('LD V0x{:X}, K'.format(x))
-
-            vm.is_expecting_key = True
-            vm.key_listener = update_register
-
-        # LD DT, Vx
-        elif opcode & 0xF0FF == 0xF015:
-            vm.dt = registers[x]
-            logger.debug('LD DT, V0x{:X}'.format(x))
-
-        # LD ST, Vx
-        elif opcode & 0xF0FF == 0xF018:
-            vm.st = registers[x]
-            logger.debug('LD ST, V0x{:X}'.format(x))
-
-        # ADD I, Vx
-        elif opcode & 0xF0FF == 0xF01E:
-            vm.i_register += registers[x]
-            logger.debug('ADD I, V0x{:X}'.format(x))
-
-        # LD F, Vx
-        elif opcode & 0xF0FF == 0xF029:
-            vm.i_register = registers[x] * HEX_SPRITE_SIZE
-            logger.debug('LD F, V0x{:X}'.format(x))
-
-        # LD B, Vx
-        elif opcode & 0xF0FF == 0xF033:
-            addr = vm.i_register
-            number = registers[x]
-            for i in range(addr + 2, addr - 1, -1):
-                vm.memory[i] = number % 10
-                number //= 10
-            logger.debug('LD B, V0x{:X}'.format(x))
-
-        # LD [I], Vx
-        elif opcode & 0xF0FF == 0xF055:
-            addr = vm.i_register
-            for r in range(0, x + 1):
-                vm.memory[addr + r] = registers[r]
-            logger.debug('LD [I], V0x{:X}'.format(x))
-
-        # LD Vx, [I]
-        elif opcode & 0xF0FF == 0xF065:
-            addr = vm.i_register
-            for r in range(0, x + 1):
-                registers[r] = vm.memory[addr + r]
-            logger.debug('LD V0x{:X}, [I]'.format(x))
-
-    def display(self, opcode):
+        registers[x] += value
+
+        if registers[x] > 0xFF:
+            registers[x] -= 0xFF + 1
+
+    # VF is reserved, hence the x and y assertions of 8XYN instructions
+
+    def load_register(self, x, y):
+        assert (x < 0xF and y < 0xF)
+        self.vm.v_registers[x] = self.vm.v_registers[y]
+
+    def or_registers(self, x, y):
+        assert (x < 0xF and y < 0xF)
+        self.vm.v_registers[x] |= self.vm.v_registers[y]
+
+    def and_registers(self, x, y):
+        assert (x < 0xF and y < 0xF)
+        self.vm.v_registers[x] &= self.vm.v_registers[y]
+
+    def xor_registers(self, x, y):
+        assert (x < 0xF and y < 0xF)
+        self.vm.v_registers[x] ^= self.vm.v_registers[y]
+
+    def add_registers(self, x, y):
+        assert (x < 0xF and y < 0xF)
+        registers = self.vm.v_registers
+        registers[x] += registers[y]
+        registers[0xF] = int(registers[x] > 0xFF)
+
+        if registers[x] > 0xFF:
+            registers[x] -= 0xFF + 1
+
+    def sub_registers(self, x, y):
+        assert (x < 0xF and y < 0xF)
+        registers = self.vm.v_registers
+        registers[0xF] = int(registers[y] > registers[x])
+        val_x = registers[x] - registers[y]
+
+        if val_x < 0:
+            val_x += 0xFF + 1
+        registers[x] = val_x
+
+    def shift_right(self, x, y):
+        assert (x < 0xF and y < 0xF)
+        registers = self.vm.v_registers
+        registers[0xF] = int(registers[x] & 0x1 == 0x1)
+        registers[x] >>= 1
+
+    def subn_registers(self, x, y):
+        assert (x < 0xF and y < 0xF)
+        registers = self.vm.v_registers
+        registers[0xF] = int(registers[x] > registers[y])
+        val_x = registers[y] - registers[x]
+
+        if val_x < 0:
+            val_x += 0xFF + 1
+
+        registers[x] = val_x
+
+    def shift_left(self, x, y):
+        assert (x < 0xF and y < 0xF)
+        registers = self.vm.v_registers
+        registers[0xF] = int(registers[x] & 0x80 == 0x80)
+        registers[x] <<= 1
+
+    def load_i(self, value):
+        self.vm.i_register = value
+
+    def random(self, x, mask):
+        self.vm.v_registers[x] = self.vm.random.randbyte() & mask
+
+    def load_delay_timer(self, x):
+        self.vm.v_registers[x] = self.vm.dt
+
+    def wait_key(self, x):
+        self.vm.key_register = x
+
+    def set_delay_timer(self, x):
+        self.vm.dt = self.vm.v_registers[x]
+
+    def set_sound_timer(self, x):
+        self.vm.st = self.vm.v_registers[x]
+
+    def add_i(self, x):
+        self.vm.i_register += self.vm.v_registers[x]
+
+    def load_font(self, x):
+        self.vm.i_register = self.vm.v_registers[x] * HEX_SPRITE_SIZE
+
+    def store_bcd(self, x):
+        memory = self.vm.memory
+        addr = self.vm.i_register
+        number = self.vm.v_registers[x]
+        for i in range(addr + 2, addr - 1, -1):
+            memory[i] = number % 10
+            number //= 10
+        self.vm.invalidate_code(addr, addr + 3)
+
+    def store_registers(self, x):
+        memory = self.vm.memory
+        registers = self.vm.v_registers
+        addr = self.vm.i_register
+        for r in range(0, x + 1):
+            # 8XYE can store values above 0xFF, memory cells are 8 bits
+            memory[addr + r] = registers[r] & 0xFF
+        self.vm.invalidate_code(addr, addr + x + 1)
+
+    def load_registers(self, x):
+        memory = self.vm.memory
+        registers = self.vm.v_registers
+        addr = self.vm.i_register
+        for r in range(0, x + 1):
+            registers[r] = memory[addr + r]
+
+    def display(self, x, y, n):
         """
         Display operations
         """
-        addr = self.vm.i_register
-        n = opcode & 0x000F
-        x = (opcode & 0x0F00) >> 8
-        y = (opcode & 0x00F0) >> 4
-        register_x = self.vm.v_registers[x]
-        register_y = self.vm.v_registers[y]
+        vm = self.vm
+        registers = vm.v_registers
+        memory = vm.memory
+        rows = vm.display_rows
+        addr = vm.i_register
+        register_x = registers[x]
+        register_y = registers[y]
 
-        self.vm.logger.debug(
-            'DRW A 0x{:X}, N 0x{:X}, X 0x{:X}, Y 0x{:X}'.format(addr, n, x, y))
+        # Sprite rows are rotated to their position so that they wrap around
+        shift = register_x % DISPLAY_WIDTH
+        collision = 0
 
-        self.vm.v_registers[0xF] = 0
+        for line in range(0, n):
+            sprite = (memory[addr + line] & 0xFF) << (DISPLAY_WIDTH - 8)
+            sprite = (sprite >> shift | sprite << (DISPLAY_WIDTH - shift)) \
+                & DISPLAY_ROW_MASK
+            row = (register_y + line) % DISPLAY_HEIGHT
+            collision |= rows[row] & sprite
+            rows[row] ^= sprite
 
-        memory = self.vm.memory
+        registers[0xF] = 1 if collision else 0
 
-        for y in range(0, n):
-            sprite = memory[addr + y]
-            for x in range(0, 8):
-                if sprite & 0x80:
-                    collision = self.vm.set_pixel(register_x + x, register_y + y)
-                    if collision:
-                        self.vm.v_registers[0xF] = 1
-                sprite <<= 1
+        vm.mark_dirty(register_x, register_y, 8, n)
 
 
 class Chip8(object):
@@ -366,15 +433,15 @@ class Chip8(object):
     CHIP-8 VM
     """
 
-    def __init__(self, event_loop, keyboard, renderer):
+    def __init__(self, event_loop, keyboard, renderer, engine=None):
 
         # 4kB memory
-        self.memory = array('I', (0 for _ in range(0xFFF + 1)))
+        self.memory = bytearray(MEMORY_SIZE)
         # 16-bits stack
-        self.stack = array('I', (0 for _ in range(0xF + 1)))
+        self.stack = array('I', [0]) * 16
 
         # 16 x 8-bits registers
-        self.v_registers = array('I', (0 for _ in range(0xF + 1)))
+        self.v_registers = array('I', [0]) * 16
         # 16-bits register
         self.i_register = None
 
@@ -388,11 +455,18 @@ class Chip8(object):
         # 8-bits stack pointer
         self.sp = None
 
-        self.display = array('I', [0] * (DISPLAY_WIDTH * DISPLAY_HEIGHT))
+        # One integer per display row, most significant bit on the left
+        self.display_rows = [0] * DISPLAY_HEIGHT
+
+        # CXNN random numbers, seeded with set_seed for reproducible runs
+        self.random = Random()
 
         self.processor = Processor(self)
+        # Executes code, either the processor or an engine built from it
+        self.engine = engine(self) if engine else self.processor
         self.keyboard = keyboard
         self.renderer = renderer
+        self.presenter = Presenter(renderer)
         self.event_loop = event_loop
 
         self.logger = None
@@ -400,42 +474,156 @@ class Chip8(object):
 
         self.running = False
         self.display_refresh_needed = False
-        self.is_expecting_key = False
-        self.key_listener = lambda x: x
-        self.delta_t = 0  # Delta T accumulator
+        # (x, y, width, height) display areas changed since last refresh
+        self.dirty_rects = []
+        # Register awaiting a key press (FX0A), None if not waiting
+        self.key_register = None
+        # Latest snapshot, whose memory copy later ones share if unchanged
+        self.last_snapshot = None
+        self.tracer = None
+        self.profiler = None
+        self.recorder = None
+        self.rewind = None
+        self.metrics = None
+        self.sound = None
+        self.capture = None
+        self.turbo = False  # Running uncapped, see set_turbo
+        self.frame_cycles = 0  # Instructions owed to the current frame
+        self.cycles = 0  # Executed instructions
+        self.max_cycles = None
+        # Fast-forward through idle loops, see skip_idle_loop
+        self.skip_idle = True
+        self.idle_cycles = 0  # Instructions skipped in idle loops
+        self.idle_opcodes = {}  # Opcode -> whether it may be in an idle loop
+        self.frames = 0  # Executed 60Hz frames
+        self.max_frames = None
+        # Stopped waiting for a key no input is left to press, see end_frame
+        self.blocked = False
 
         self.reset()
 
     def setup_logging(self):
         self.logger = logging.getLogger('chip-8')
         self.logger.setLevel('INFO')
-        ch = logging.StreamHandler(sys.stdout)
-        self.logger.addHandler(ch)
+        # The logger is shared by all VMs of the process
+        if not self.logger.handlers:
+            ch = logging.StreamHandler(sys.stdout)
+            self.logger.addHandler(ch)
 
     def set_debug(self, debug):
+        from lib.trace import Tracer
+
         if debug:
             debug_level = 'DEBUG'
+            self.set_tracer(Tracer(self, logger=self.logger))
         else:
             debug_level = 'ERROR'
+            self.set_tracer(None)
 
         self.logger.setLevel(debug_level)
 
+    def set_tracer(self, tracer):
+        """
+        Run instructions through tracer, or stop tracing if tracer is None.
+        Untraced execution does not pay anything for tracing support.
+        """
+        self.tracer = tracer
+
+    def set_profiler(self, profiler):
+        """
+        Run instructions through profiler.Profiler profiler, or stop
+        profiling if profiler is None. Tracing takes precedence.
+        """
+        self.profiler = profiler
+
+    def set_seed(self, seed):
+        self.random.seed(seed)
+
+    def set_recorder(self, recorder):
+        """
+        Let movie.Recorder recorder log key state changes after each frame,
+        or stop recording if recorder is None
+        """
+        self.recorder = recorder
+
+    def set_metrics(self, metrics):
+        """
+        Let metrics.Metrics metrics sample counters after each frame, or stop
+        sampling if metrics is None
+        """
+        self.metrics = metrics
+
+    def set_sound(self, sound):
+        """
+        Let sound.Sound sound play while the sound timer is above zero, or
+        mute the VM if sound is None
+        """
+        self.sound = sound
+
+    def set_capture(self, capture):
+        """
+        Let capture.Capture capture record the display on refreshes, or stop
+        capturing if capture is None
+        """
+        self.capture = capture
+
+    def set_turbo(self, turbo):
+        """
+        Run frames as fast as possible, presenting only as many as rendering
+        cost allows, or back at 60 frames per second. Timers still count
+        emulated frames.
+        """
+        self.turbo = turbo
+        self.event_loop.turbo = turbo
+        self.presenter.set_turbo(turbo)
+
+    def set_rewind(self, rewind):
+        """
+        Record frames to rewind.RewindBuffer rewind, stepping back through
+        them while the keyboard rewind key is held. None disables rewinding.
+        """
+        self.rewind = rewind
+
     def reset_display(self):
-        for i, _ in enumerate(self.display):
-            self.display[i] = 0
+        self.display_rows[:] = [0] * DISPLAY_HEIGHT
 
+        self.dirty_rects = [(0, 0, DISPLAY_WIDTH, DISPLAY_HEIGHT)]
         self.display_refresh_needed = True
 
-    def reset(self):
-        for i, c in enumerate(HEX_CHARS):
-            self.memory[i] = c
+    def mark_dirty(self, x, y, width, height):
+        """
+        Record a changed display area, split where it wraps around edges
+        """
+        if not (width and height):
+            return
+
+        self.display_refresh_needed = True
 
-        for i in range(len(HEX_CHARS), 0xFFF):
-            self.memory[i] = 0
+        if len(self.dirty_rects) >= MAX_DIRTY_RECTS:
+            # Cheaper to redraw everything than that many areas
+            self.dirty_rects = [(0, 0, DISPLAY_WIDTH, DISPLAY_HEIGHT)]
+            return
+
+        x %= DISPLAY_WIDTH
+        y %= DISPLAY_HEIGHT
+        columns = [(x, min(width, DISPLAY_WIDTH - x))]
+        if x + width > DISPLAY_WIDTH:
+            columns.append((0, x + width - DISPLAY_WIDTH))
+        rows = [(y, min(height, DISPLAY_HEIGHT - y))]
+        if y + height > DISPLAY_HEIGHT:
+            rows.append((0, y + height - DISPLAY_HEIGHT))
+
+        for column, column_width in columns:
+            for row, row_height in rows:
+                self.dirty_rects.append(
+                    (column, row, column_width, row_height))
+
+    def reset(self):
+        self.memory[:] = bytes(MEMORY_SIZE)
+        self.memory[:len(HEX_CHARS)] = bytes(HEX_CHARS)
 
-        for i in range(0xF):
-            self.stack[i] = 0
-            self.v_registers[i] = 0
+        self.stack[:] = array('I', [0]) * 16
+        self.v_registers[:] = array('I', [0]) * 16
 
         self.reset_display()
 
@@ -444,79 +632,321 @@ class Chip8(object):
         self.dt = 0
         self.st = 0
 
-        self.pc = 0x200
+        self.pc = PROGRAM_START
         self.sp = 0
 
-    def load(self, program_file_name):
-        addr = 0x200
+        self.key_register = None
 
-        self.logger.info('Loading program "{}"'.format(program_file_name))
-        with open(program_file_name, 'rb') as program_file:
-            while True:
-                byte_s = program_file.read(1)
-                if not byte_s:
-                    break
-                self.memory[addr] = byte_s[0]
-                addr += 1
+        self.invalidate_code(0, len(self.memory))
+
+        self.cycles = 0
+        self.idle_cycles = 0
+        self.frames = 0
 
-    def start(self):
+    def load(self, program):
+        """
+        Load program at 0x200, from a file name or a bytes-like object such
+        as bytes or an mmap
+        """
+        if isinstance(program, str):
+            self.logger.info('Loading program "{}"'.format(program))
+            with open(program, 'rb') as program_file:
+                # One byte more than fits, to detect programs too big
+                program = program_file.read(PROGRAM_MAX_SIZE + 1)
+
+        size = len(program)
+        if size > PROGRAM_MAX_SIZE:
+            raise InvalidProgram(
+                'Program does not fit in memory, {} bytes above {}'.format(
+                    size, PROGRAM_MAX_SIZE))
+
+        end = PROGRAM_START + size
+        self.memory[PROGRAM_START:end] = program
+        self.invalidate_code(PROGRAM_START, end)
+
+    def start(self, max_cycles=None, max_frames=None):
+        """
+        Run the loaded program, optionally stopping after max_cycles more
+        instructions or max_frames more 60Hz frames
+        """
+        # Counters do not start from zero after restoring a state
+        self.max_cycles = None if max_cycles is None else \
+            self.cycles + max_cycles
+        self.max_frames = None if max_frames is None else \
+            self.frames + max_frames
+        self.blocked = False
         self.running = True
-        self.run_cycle()
+        try:
+            self.run_cycle()
+        finally:
+            self.presenter.close()
+            if self.sound is not None:
+                self.sound.stop()
 
     def stop(self):
         self.running = False
 
     def update_timers(self):
-        has_to_decrement = self.delta_t > 1/TIMERS_UPDATE_FREQUENCY
-        if has_to_decrement:
-            if self.dt > 0:
-                self.dt -= 1
-            if self.st > 0:
-                self.st -= 1
-                if self.st <= 0:
-                    self.renderer.beep()
-
-            self.delta_t = 0
+        """
+        Decrement timers, called once per 60Hz frame
+        """
+        if self.dt > 0:
+            self.dt -= 1
+        # Sound plays for as many frames as the timer value
+        if self.sound is not None:
+            self.sound.update(self.st)
+        if self.st > 0:
+            self.st -= 1
 
     def run_cycle(self):
         while self.running:
-            if self.is_expecting_key:
-                key_state = self.keyboard.get_key_state()
-                if key_state is not None:
-                    self.key_listener(key_state)
+            self.run_frame()
 
-            else:
-                opcode = self.memory[self.pc] << 8 | self.memory[self.pc + 1]
-                self.logger.debug(
-                    'READ OPCODE 0x{:X} AT 0x{:X}'.format(opcode, self.pc))
-                self.processor.run(opcode)
+    def run_frame(self):
+        """
+        Run a 60Hz frame worth of instructions, then poll input, update timers
+        and submit the frame for presentation if anything was drawn
+        """
+        if self.rewind is not None and self.keyboard.rewinding:
+            self.rewind_frame()
+            return
 
-                if self.display_refresh_needed:
-                    self.refresh_display()
+        self.execute(self.frame_budget())
+        self.end_frame()
 
-            self.delta_t += self.event_loop.tick() / 1000  # ms -> s
-            self.update_timers()
+    def frame_budget(self):
+        """
+        Return the number of instructions of the next frame
+        """
+        frequency = self.event_loop.frequency
+        self.frame_cycles += frequency / TIMERS_UPDATE_FREQUENCY
+        budget = int(self.frame_cycles)
+        self.frame_cycles -= budget
 
-    def set_pixel(self, x, y):
-        while x >= DISPLAY_WIDTH:
-            x -= DISPLAY_WIDTH
-        while x < 0:
-            x += DISPLAY_WIDTH
+        if self.max_cycles is not None:
+            budget = max(min(budget, self.max_cycles - self.cycles), 0)
+        return budget
 
-        while y >= DISPLAY_HEIGHT:
-            y -= DISPLAY_HEIGHT
-        while y < 0:
-            y += DISPLAY_HEIGHT
+    def end_frame(self):
+        """
+        Count a frame whose instructions ran, then poll input, update timers
+        and submit it for presentation
+        """
+        self.frames += 1
+        # Rewinding may restore counters past the budgets
+        if self.max_cycles is not None and self.cycles >= self.max_cycles or \
+                self.max_frames is not None and self.frames >= self.max_frames:
+            self.stop()
+
+        self.event_loop.tick()
+        if self.key_register is not None and self.max_frames is None and \
+                self.keyboard.get_key_state() is None and \
+                self.keyboard.is_exhausted():
+            # No instruction would ever run again. Runs bounded by frames
+            # still run them, timers counting down.
+            self.blocked = True
+            self.stop()
+        if self.keyboard.turbo != self.turbo:
+            self.set_turbo(self.keyboard.turbo)
+        self.update_timers()
+
+        if self.recorder is not None:
+            self.recorder.record()
+        if self.rewind is not None:
+            self.rewind.record()
+        if self.metrics is not None:
+            self.metrics.update()
+
+        if self.display_refresh_needed:
+            self.refresh_display()
+        self.presenter.update()
+
+    def rewind_frame(self):
+        """
+        Go back to the previous recorded frame instead of running one
+        """
+        self.rewind.step_back()
+        # The tone resumes with the sound timer once running forward again
+        if self.sound is not None:
+            self.sound.stop()
+
+        self.event_loop.tick()
 
-        coord = (y * DISPLAY_WIDTH) + x
+        if self.display_refresh_needed:
+            self.refresh_display()
+        self.presenter.update()
 
-        self.display[coord] ^= 1
+    def execute(self, budget):
+        """
+        Execute up to budget instructions, stopping early when waiting for
+        a key press and skipping idle loops
+        """
+        # Tracing and profiling see every instruction
+        next_idle_check = budget
+        if self.tracer is not None:
+            step = self.tracer.step
+        elif self.profiler is not None:
+            step = self.profiler.step
+        else:
+            step = self.engine.step
+            if self.skip_idle:
+                next_idle_check = 0
+        idle_check_interval = IDLE_CHECK_INTERVAL
+        executed = 0
+
+        while executed < budget:
+            if self.key_register is not None:
+                key_state = self.keyboard.get_key_state()
+                if key_state is None:
+                    # Input is only polled between frames
+                    break
+                self.v_registers[self.key_register] = key_state
+                self.key_register = None
+
+            if executed >= next_idle_check:
+                idle_cycles = self.idle_cycles
+                executed += self.skip_idle_loop(budget - executed)
+                if self.idle_cycles == idle_cycles:
+                    idle_check_interval *= 2
+                next_idle_check = executed + idle_check_interval
+                continue
+
+            executed += step(budget - executed)
+
+        self.cycles += executed
+
+    def is_idle_instruction(self, addr):
+        opcode = self.memory[addr] << 8 | self.memory[addr + 1]
+        idle = self.idle_opcodes.get(opcode)
+        if idle is None:
+            try:
+                idle = Processor.identify(opcode)[0] in IDLE_INSTRUCTIONS
+            except UnsupportedOpCode:
+                idle = False
+            self.idle_opcodes[opcode] = idle
+        return idle
+
+    def skip_idle_loop(self, budget):
+        """
+        Run the loop at PC for up to two iterations. If it is an idle loop,
+        coming back to PC with the same registers after only running
+        IDLE_INSTRUCTIONS, the next iterations would be the same until the
+        next frame: as many whole iterations as fit in budget are counted
+        as executed without being run. Returns the number of instructions
+        run or skipped.
+        """
+        processor = self.processor
+        start = self.pc
+        executed = 0
+
+        # The first iteration may be the first to read a new timer value
+        for _ in range(2):
+            v_registers = self.v_registers[:]
+            i_register = self.i_register
+            length = 0
+            while True:
+                if executed == budget or length == MAX_IDLE_LOOP_LENGTH or \
+                        self.pc + 1 >= len(self.memory) or \
+                        not self.is_idle_instruction(self.pc):
+                    return executed
+                executed += processor.step()
+                length += 1
+                if self.pc == start:
+                    break
+
+            if self.v_registers == v_registers and \
+                    self.i_register == i_register:
+                skipped = (budget - executed) // length * length
+                self.idle_cycles += skipped
+                return executed + skipped
+
+        return executed
+
+    def invalidate_code(self, start, end):
+        """
+        Notify execution engines that the [start, end[ memory range changed
+        """
+        self.processor.invalidate(start, end)
+        if self.engine is not self.processor:
+            self.engine.invalidate(start, end)
+
+    def snapshot(self):
+        """
+        Return a snapshot.Snapshot of the VM state
+        """
+        memory = bytes(self.memory)
+        last = self.last_snapshot
+        if last is not None and last.memory == memory:
+            memory = last.memory
+
+        self.last_snapshot = snapshot.Snapshot(
+            memory=memory,
+            stack=self.stack[:],
+            v_registers=self.v_registers[:],
+            i_register=self.i_register,
+            dt=self.dt,
+            st=self.st,
+            pc=self.pc,
+            sp=self.sp,
+            display_rows=tuple(self.display_rows),
+            key_register=self.key_register,
+            random_state=self.random.state,
+            frame_cycles=self.frame_cycles,
+            cycles=self.cycles,
+            frames=self.frames)
+        return self.last_snapshot
+
+    def restore(self, state):
+        """
+        Restore a snapshot.Snapshot, or its serialized bytes
+        """
+        if isinstance(state, (bytes, bytearray)):
+            state = snapshot.unpack(state)
+
+        memory = state.memory
+        for start in range(0, len(memory), MEMORY_PAGE_SIZE):
+            end = start + MEMORY_PAGE_SIZE
+            if self.memory[start:end] != memory[start:end]:
+                self.memory[start:end] = memory[start:end]
+                self.invalidate_code(start, end)
+
+        self.stack[:] = array('I', state.stack)
+        self.v_registers[:] = array('I', state.v_registers)
+        self.i_register = state.i_register
+        self.dt = state.dt
+        self.st = state.st
+        self.pc = state.pc
+        self.sp = state.sp
+        self.key_register = state.key_register
+        self.random.state = state.random_state
+        self.frame_cycles = state.frame_cycles
+        self.cycles = state.cycles
+        self.frames = state.frames
+
+        self.display_rows[:] = state.display_rows
+        self.dirty_rects = [(0, 0, DISPLAY_WIDTH, DISPLAY_HEIGHT)]
         self.display_refresh_needed = True
 
-        return not self.display[coord]
+        self.last_snapshot = state._replace(memory=memory)
+
+    @property
+    def display(self):
+        """
+        Display as a bytearray holding one 0 or 1 byte per pixel, row after row
+        """
+        return rows_to_pixels(self.display_rows, DISPLAY_WIDTH)
+
+    def set_presenter(self, presenter):
+        self.presenter = presenter
 
     def refresh_display(self):
-        self.renderer.refresh(self.display)
+        """
+        Hand the current frame over to the presenter
+        """
+        self.presenter.submit(self.display_rows, self.dirty_rects)
+        if self.capture is not None:
+            self.capture.submit(self.frames, self.display_rows)
+        self.dirty_rects = []
         self.display_refresh_needed = False
 
     def get_key(self):
@@ -0,0 +1,219 @@
+"""
+Execution engine compiling straight-line CHIP-8 code into Python functions.
+
+A block starts at PC and runs until an instruction which transfers control,
+waits for or reads the outside world, draws or writes memory. Everything
+before that terminating instruction is translated to Python statements on
+local variables, the terminating instruction is run through the Processor
+handler once registers have been written back.
+"""
+import re
+
+from lib.chip8 import Processor, UnsupportedOpCode, HEX_SPRITE_SIZE
+
+MAX_BLOCK_LENGTH = 64
+
+
+def load_registers_source(x):
+    return '\n'.join('v{0:x} = m[i + {0}]'.format(r) for r in range(0, x + 1))
+
+
+# Handler name -> Python statements, formatted with the handler operands
+# or built by a function taking them
+INLINE_INSTRUCTIONS = {
+    'clear_display': 'p.clear_display()',
+    'load': 'v{0:x} = {1}',
+    'add': 'v{0:x} += {1}\n'
+           'if v{0:x} > 0xFF: v{0:x} -= 0x100',
+    'load_register': 'v{0:x} = v{1:x}',
+    'or_registers': 'v{0:x} |= v{1:x}',
+    'and_registers': 'v{0:x} &= v{1:x}',
+    'xor_registers': 'v{0:x} ^= v{1:x}',
+    'add_registers': 'v{0:x} += v{1:x}\n'
+                     'vf = 1 if v{0:x} > 0xFF else 0\n'
+                     'if v{0:x} > 0xFF: v{0:x} -= 0x100',
+    'sub_registers': 'vf = 1 if v{1:x} > v{0:x} else 0\n'
+                     'v{0:x} -= v{1:x}\n'
+                     'if v{0:x} < 0: v{0:x} += 0x100',
+    'shift_right': 'vf = v{0:x} & 0x1\n'
+                   'v{0:x} >>= 1',
+    'subn_registers': 'vf = 1 if v{0:x} > v{1:x} else 0\n'
+                      'v{0:x} = v{1:x} - v{0:x}\n'
+                      'if v{0:x} < 0: v{0:x} += 0x100',
+    'shift_left': 'vf = 1 if v{0:x} & 0x80 else 0\n'
+                  'v{0:x} <<= 1',
+    'load_i': 'i = {0}',
+    'random': 'v{0:x} = randbyte() & {1}',
+    'load_delay_timer': 'v{0:x} = vm.dt',
+    'set_delay_timer': 'vm.dt = v{0:x}',
+    'set_sound_timer': 'vm.st = v{0:x}',
+    'add_i': 'i += v{0:x}',
+    'load_font': 'i = v{0:x} * ' + str(HEX_SPRITE_SIZE),
+    'load_registers': load_registers_source,
+}
+
+# 8XYN instructions are only inlined when they do not involve VF
+REGISTER_INSTRUCTIONS = {
+    'load_register', 'or_registers', 'and_registers', 'xor_registers',
+    'add_registers', 'sub_registers', 'shift_right', 'subn_registers',
+    'shift_left'
+}
+
+REGISTER_NAME = re.compile(r'\bv([0-9a-f])\b')
+I_NAME = re.compile(r'\bi\b')
+
+
+class Block(object):
+    """
+    Compiled straight-line code
+    """
+
+    __slots__ = ('function', 'start', 'end', 'length')
+
+    def __init__(self, function, start, end, length):
+        self.function = function
+        self.start = start
+        self.end = end
+        self.length = length
+
+
+class BlockCompiler(object):
+    """
+    Alternative to Processor.step running whole compiled blocks at once
+    """
+
+    def __init__(self, vm):
+        self.vm = vm
+        self.processor = vm.processor
+        # Start address -> Block
+        self.blocks = {}
+        # Address -> start addresses of the blocks covering it
+        self.coverage = [None] * len(vm.memory)
+
+    def step(self, limit=MAX_BLOCK_LENGTH):
+        """
+        Run the block at PC if it has no more than limit instructions,
+        a single instruction otherwise. Returns the number of instructions
+        executed.
+        """
+        vm = self.vm
+        block = self.blocks.get(vm.pc)
+
+        if block is None:
+            block = self.compile(vm.pc)
+            if block is None:
+                return self.processor.step()
+
+        if block.length > limit:
+            return self.processor.step()
+
+        block.function(vm, self.processor)
+        return block.length
+
+    def invalidate(self, start, end):
+        """
+        Drop compiled blocks overlapping the [start, end[ memory range
+        """
+        coverage = self.coverage
+        for addr in range(start, min(end, len(coverage))):
+            if coverage[addr]:
+                for block_start in list(coverage[addr]):
+                    self.discard(block_start)
+
+    def discard(self, block_start):
+        block = self.blocks.pop(block_start)
+        for addr in range(block.start, block.end):
+            self.coverage[addr].discard(block_start)
+
+    def decode(self, addr):
+        """
+        Return the (handler name, operands) of the instruction at addr, or
+        None if it cannot be decoded
+        """
+        memory = self.vm.memory
+        if addr + 1 >= len(memory):
+            return None
+
+        try:
+            return Processor.identify(memory[addr] << 8 | memory[addr + 1])
+        except UnsupportedOpCode:
+            return None
+
+    def is_inline(self, name, operands):
+        if name not in INLINE_INSTRUCTIONS:
+            return False
+        if name in REGISTER_INSTRUCTIONS:
+            return operands[0] < 0xF and operands[1] < 0xF
+        return True
+
+    def compile(self, start):
+        """
+        Discover and compile the block starting at start, None if the
+        instruction at start cannot be decoded
+        """
+        body = []
+        terminator = None
+        addr = start
+
+        while len(body) < MAX_BLOCK_LENGTH:
+            instruction = self.decode(addr)
+            if instruction is None:
+                break
+
+            name, operands = instruction
+            addr += 2
+
+            if not self.is_inline(name, operands):
+                terminator = instruction
+                break
+
+            template = INLINE_INSTRUCTIONS[name]
+            if callable(template):
+                body.append(template(*operands))
+            else:
+                body.append(template.format(*operands))
+
+        length = len(body) + (terminator is not None)
+        if not length:
+            return None
+
+        source = '\n'.join(body)
+        registers = sorted(set(REGISTER_NAME.findall(source)))
+        uses_i = I_NAME.search(source) is not None
+
+        prologue = ['r = vm.v_registers', 'm = vm.memory']
+        prologue += ['v{0} = r[0x{0}]'.format(r) for r in registers]
+        epilogue = ['r[0x{0}] = v{0}'.format(r) for r in registers]
+        if uses_i:
+            prologue.append('i = vm.i_register')
+            epilogue.append('vm.i_register = i')
+        epilogue.append('vm.pc = 0x{:X}'.format(addr))
+
+        if terminator is not None:
+            name, operands = terminator
+            epilogue.append('p.{}({})'.format(
+                name, ', '.join(str(operand) for operand in operands)))
+
+        lines = prologue + source.split('\n') + epilogue
+        function_source = 'def block(vm, p):\n' + '\n'.join(
+            '    ' + line for line in lines if line)
+
+        namespace = {'randbyte': self.vm.random.randbyte}
+        exec(compile(function_source, '<block 0x{:X}>'.format(start), 'exec'),
+             namespace)
+
+        block = Block(namespace['block'], start, addr, length)
+        self.blocks[start] = block
+        for covered in range(start, addr):
+            if self.coverage[covered] is None:
+                self.coverage[covered] = set()
+            self.coverage[covered].add(start)
+
+        return block
+
+
+# Execution engine name -> engine class, None for the interpreter
+ENGINES = {
+    'interpreter': None,
+    'compiler': BlockCompiler,
+}
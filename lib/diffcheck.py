@@ -0,0 +1,305 @@
+"""
+Differential checker: runs programs on the reference interpreter and on
+another execution engine side by side, comparing a hash of their state
+every few instructions. On a mismatch, both are restored to the last
+matching state and the first differing instruction is found by bisection.
+
+    python3 -m lib.diffcheck [options] ROMS...
+
+ROMS are given as for lib.batch. A program with a movie next to it, such as
+pong.c8m for pong.ch8, is run with the movie's keys, seed and frequency.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import struct
+import sys
+import time
+import zlib
+
+from lib import chip8, movie
+from lib.batch import create_vm, find_roms
+from lib.compiler import ENGINES
+from lib.trace import disassemble
+
+# Engines checked against the interpreter
+CHECKED_ENGINES = tuple(name for name, engine in ENGINES.items()
+                        if engine is not None)
+DEFAULT_INTERVAL = 1000
+DEFAULT_SEED = 0
+
+# pc, I, SP, DT, ST, key register (-1 if none), V registers, stack, display
+STATE = struct.Struct('>5Ii16I16I{}Q'.format(chip8.DISPLAY_HEIGHT))
+
+# VM attributes compared between engines
+STATE_FIELDS = ('pc', 'i_register', 'sp', 'dt', 'st', 'key_register',
+                'v_registers', 'stack', 'display_rows', 'memory')
+
+
+def state_hash(vm):
+    """
+    CRC of the STATE_FIELDS of vm, the same in every process and on every
+    machine
+    """
+    key_register = -1 if vm.key_register is None else vm.key_register
+    state = STATE.pack(vm.pc, vm.i_register, vm.sp, vm.dt, vm.st,
+                       key_register, *(list(vm.v_registers) + list(vm.stack) +
+                                       list(vm.display_rows)))
+    return zlib.crc32(vm.memory, zlib.crc32(state))
+
+
+def differing_fields(reference, vm):
+    return [name for name in STATE_FIELDS
+            if getattr(reference, name) != getattr(vm, name)]
+
+
+def execute(vm, count):
+    """
+    Run count instructions, returning the state hash or the name of the
+    exception raised
+    """
+    try:
+        vm.execute(count)
+    except Exception as e:
+        return type(e).__name__
+    return state_hash(vm)
+
+
+class Lockstep(object):
+    """
+    A program running on the reference interpreter and on engine
+    """
+
+    def __init__(self, program, engine, frequency=chip8.CLOCK_FREQUENCY,
+                 script=(), seed=DEFAULT_SEED, interval=DEFAULT_INTERVAL):
+        self.reference = create_vm(frequency, None, script)
+        self.vm = create_vm(frequency, engine, script)
+        for vm in (self.reference, self.vm):
+            # Have the engine run every instruction
+            vm.skip_idle = False
+            vm.load(program)
+            vm.set_seed(seed)
+        self.interval = interval
+        self.checks = 0
+        # Rolling hash of the checked states, identifying the whole run
+        self.hash = 0
+        # States of the latest check, both VMs being identical then
+        self.checkpoint = None
+
+    def save(self):
+        self.checkpoint = self.reference.snapshot(), self.vm.snapshot()
+
+    def restore(self):
+        self.reference.restore(self.checkpoint[0])
+        self.vm.restore(self.checkpoint[1])
+
+    def run(self, cycles=None, frames=None):
+        """
+        Run until cycles instructions or frames frames, or until both engines
+        wait for a key no input is left to press. Returns None, or a report
+        of the first divergence, with 'error' set if both engines failed the
+        same way.
+        """
+        reference, vm = self.reference, self.vm
+        for each in (reference, vm):
+            each.max_cycles = cycles
+            each.max_frames = frames
+            each.blocked = False
+            each.running = True
+        self.save()
+
+        # Engines stopping apart would have diverged first
+        while reference.running and vm.running:
+            budget = reference.frame_budget()
+            vm.frame_budget()
+
+            while budget > 0:
+                count = min(budget, self.interval)
+                budget -= count
+
+                expected = execute(reference, count)
+                actual = execute(vm, count)
+                if expected != actual:
+                    return self.bisect(count)
+                if isinstance(expected, str):
+                    return {'error': expected}
+
+                self.checks += 1
+                self.hash = zlib.crc32(expected.to_bytes(4, 'big'),
+                                       self.hash)
+                self.save()
+
+            reference.end_frame()
+            vm.end_frame()
+
+        return None
+
+    def bisect(self, count):
+        """
+        Find the instruction within count after the checkpoint from which
+        the engines diverge: running the instructions before it from the
+        checkpoint gives identical states, running it too does not. It is
+        the first one unless states diverged and became identical again.
+        Engines running blocks of instructions at once take the interpreter
+        for blocks which do not fit in the instructions to run, so the
+        instruction found ends the block which diverged.
+        """
+        low, high = 1, count
+        while low < high:
+            middle = (low + high) // 2
+            self.restore()
+            if execute(self.reference, middle) != execute(self.vm, middle):
+                high = middle
+            else:
+                low = middle + 1
+
+        reference = self.reference
+        self.restore()
+        execute(reference, low - 1)
+        pc = reference.pc
+        opcode = reference.memory[pc] << 8 | reference.memory[pc + 1]
+
+        self.restore()
+        expected = execute(reference, low)
+        actual = execute(self.vm, low)
+
+        return {
+            'error': None,
+            'cycle': self.checkpoint[0].cycles + low - 1,
+            'frame': reference.frames,
+            'pc': pc,
+            'instruction': disassemble(opcode),
+            'reference_error': expected if isinstance(expected, str)
+            else None,
+            'engine_error': actual if isinstance(actual, str) else None,
+            'fields': differing_fields(reference, self.vm),
+        }
+
+
+def find_movie(rom):
+    path = os.path.splitext(rom)[0] + '.c8m'
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as movie_file:
+        return movie.read_movie(movie_file)
+
+
+def check_rom(job):
+    """
+    Run a program in lockstep and return its report entry
+    """
+    rom, cycles, frames, frequency, engine_name, interval = job
+
+    script = ()
+    seed = DEFAULT_SEED
+    replay = find_movie(rom)
+    if replay is not None:
+        script, seed, frequency = replay.script, replay.seed, replay.frequency
+        frames = frames or replay.frames
+
+    result = {'rom': rom, 'error': None, 'divergence': None}
+    start_time = time.perf_counter()
+    try:
+        lockstep = Lockstep(rom, ENGINES[engine_name], frequency,
+                            script, seed, interval)
+        divergence = lockstep.run(cycles, frames)
+    except Exception as e:
+        result['error'] = '{}: {}'.format(type(e).__name__, e)
+    else:
+        if divergence is not None and divergence['error']:
+            result['error'] = divergence['error']
+        else:
+            result['divergence'] = divergence
+        result.update({
+            'blocked': lockstep.reference.blocked,
+            'cycles': lockstep.reference.cycles,
+            'frames': lockstep.reference.frames,
+            'checks': lockstep.checks,
+            'hash': '{:08x}'.format(lockstep.hash),
+        })
+    result['elapsed'] = time.perf_counter() - start_time
+    return result
+
+
+def check_roms(roms, cycles=None, frames=None,
+               frequency=chip8.CLOCK_FREQUENCY, engine='compiler',
+               interval=DEFAULT_INTERVAL, processes=None):
+    """
+    Check roms on a pool of processes, returning reports in roms order
+    """
+    jobs = [(rom, cycles, frames, frequency, engine, interval)
+            for rom in roms]
+    with multiprocessing.Pool(processes) as pool:
+        return pool.map(check_rom, jobs, chunksize=1)
+
+
+def format_divergence(divergence):
+    return 'diverged at cycle {} (frame {}), 0x{:03X} {}: {}{}{}'.format(
+        divergence['cycle'], divergence['frame'], divergence['pc'],
+        divergence['instruction'], ', '.join(divergence['fields']) or
+        'no field', ', reference raised ' + divergence['reference_error']
+        if divergence['reference_error'] else '',
+        ', engine raised ' + divergence['engine_error']
+        if divergence['engine_error'] else '')
+
+
+def main(args):
+    if args.cycles is None and args.frames is None:
+        sys.exit('A --cycles or --frames budget is required')
+
+    roms = find_roms(args.roms)
+
+    start_time = time.perf_counter()
+    results = check_roms(roms, args.cycles, args.frames,
+                         args.frequency or chip8.CLOCK_FREQUENCY,
+                         args.engine, args.interval, args.processes)
+    elapsed = time.perf_counter() - start_time
+
+    for result in results:
+        if result['divergence'] is not None:
+            status = format_divergence(result['divergence'])
+        elif result['error']:
+            status = 'failed on both engines, ' + result['error']
+        elif result['blocked']:
+            status = 'ok, blocked on a key'
+        else:
+            status = 'ok'
+        sys.stderr.write('{}: {}\n'.format(result['rom'], status))
+
+    if args.output == '-':
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    elif args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+
+    divergences = sum(1 for result in results if result['divergence'])
+    sys.stderr.write('Checked {} programs in {:.2f}s, {} divergences\n'.format(
+        len(results), elapsed, divergences))
+    if divergences:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Check an execution engine against the interpreter')
+
+    parser.add_argument('roms', type=str, nargs='+',
+                        help='.ch8 files, directories or manifests')
+    parser.add_argument('-c', '--cycles', type=int,
+                        help='stop each program after CYCLES instructions')
+    parser.add_argument('-f', '--frames', type=int,
+                        help='stop each program after FRAMES 60Hz frames')
+    parser.add_argument('-fr', '--frequency', type=float,
+                        help='CHIP-8 VM clock frequency (defaults to 1.76Mhz)')
+    parser.add_argument('-e', '--engine', default='compiler',
+                        choices=CHECKED_ENGINES, help='engine to check')
+    parser.add_argument('-i', '--interval', type=int,
+                        default=DEFAULT_INTERVAL,
+                        help='instructions between state comparisons')
+    parser.add_argument('-p', '--processes', type=int,
+                        help='worker processes (defaults to CPU count)')
+    parser.add_argument('-o', '--output', type=str,
+                        help='JSON report file, - for stdout')
+
+    main(parser.parse_args())
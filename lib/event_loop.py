@@ -1,15 +1,22 @@
 # -*- coding: utf-8 -*-
+import time
+
 import pygame
 from pygame.locals import *
 
-pygame.init()
+from lib.chip8 import TIMERS_UPDATE_FREQUENCY
 
 
 class EventLoop(object):
     def __init__(self, frequency=None):
+        # Events come from the display, the only pygame subsystem needed to
+        # start. Others are initialized on first use.
+        pygame.display.init()
         self.clock = pygame.time.Clock()
         self.keyboard = None
         self.frequency = frequency or 1000*1000
+        self.poll_time = 0  # Host seconds spent polling input
+        self.turbo = False  # Frames are not throttled in turbo mode
 
     def set_keyboard(self, keyboard):
         self.keyboard = keyboard
@@ -18,10 +25,18 @@ class EventLoop(object):
         pass
 
     def tick(self):
+        """
+        Poll input and wait for the end of the current 60Hz frame, unless in
+        turbo mode
+        """
         assert(self.keyboard is not None)
 
+        start_time = time.perf_counter()
         for event in pygame.event.get():
             if event.type in [KEYDOWN, KEYUP]:
                 self.keyboard.update_key(event)
+        self.poll_time += time.perf_counter() - start_time
 
-        return self.clock.tick(self.frequency)
\ No newline at end of file
+        if self.turbo:
+            return self.clock.tick()
+        return self.clock.tick(TIMERS_UPDATE_FREQUENCY)
\ No newline at end of file
@@ -0,0 +1,202 @@
+"""
+Randomized differential check: generates random programs and checks another
+execution engine against the interpreter on them with lib.diffcheck, so
+engine changes can be checked beyond the programs at hand.
+
+    python3 -m lib.fuzz [options]
+
+Programs are built from a seed, the same seed always giving the same program.
+A divergence reports the seed, and --directory keeps the programs to run
+them again with lib.diffcheck.
+"""
+import argparse
+import os
+import random
+import struct
+import sys
+import tempfile
+import time
+
+from lib.diffcheck import (CHECKED_ENGINES, DEFAULT_INTERVAL, check_roms,
+                           format_divergence)
+
+PROGRAM_START = 0x200
+MAIN_SIZE = 0x180  # Bytes of the main loop, jumping back to its start
+SUBROUTINES = 4
+SUBROUTINE_SIZE = 0x20  # Bytes of each subroutine, returning at its end
+# The last subroutine returns twice, a skip before a return falling into
+# the following subroutine
+DATA_START = PROGRAM_START + MAIN_SIZE + SUBROUTINES * SUBROUTINE_SIZE + 2
+DATA_SIZE = 0x100
+DEFAULT_COUNT = 100
+DEFAULT_CYCLES = 100000
+
+
+def main_address(rng):
+    return rng.randrange(PROGRAM_START, PROGRAM_START + MAIN_SIZE, 2)
+
+
+def subroutine_address(rng):
+    return PROGRAM_START + MAIN_SIZE + rng.randrange(SUBROUTINES) * \
+        SUBROUTINE_SIZE
+
+
+def memory_address(rng):
+    """
+    Return an address for I, mostly within the data, sometimes within the
+    code so that stores modify it
+    """
+    if rng.random() < 0.1:
+        return rng.randrange(PROGRAM_START, DATA_START)
+    return rng.randrange(DATA_START, DATA_START + DATA_SIZE)
+
+
+def register(rng):
+    # VF is reserved for 8XYN instructions
+    return rng.randrange(0xF)
+
+
+# (weight, opcode builder) of the instructions of subroutines. Key waits are
+# left out, no key being pressed.
+STRAIGHT_INSTRUCTIONS = (
+    (1, lambda rng: 0x00E0),
+    (3, lambda rng: 0x3000 | rng.randrange(0x10) << 8 | rng.randrange(4)),
+    (3, lambda rng: 0x4000 | rng.randrange(0x10) << 8 | rng.randrange(4)),
+    (2, lambda rng: 0x5000 | rng.randrange(0x10) << 8 |
+     rng.randrange(0x10) << 4),
+    (8, lambda rng: 0x6000 | rng.randrange(0x10) << 8 | rng.randrange(0x100)),
+    (8, lambda rng: 0x7000 | rng.randrange(0x10) << 8 | rng.randrange(0x100)),
+    (20, lambda rng: 0x8000 | register(rng) << 8 | register(rng) << 4 |
+     rng.choice((0x0, 0x1, 0x2, 0x3, 0x4, 0x5, 0x6, 0x7, 0xE))),
+    (2, lambda rng: 0x9000 | rng.randrange(0x10) << 8 |
+     rng.randrange(0x10) << 4),
+    (6, lambda rng: 0xA000 | memory_address(rng)),
+    (3, lambda rng: 0xC000 | rng.randrange(0x10) << 8 | rng.randrange(0x100)),
+    (5, lambda rng: 0xD000 | rng.randrange(0x10) << 8 |
+     rng.randrange(0x10) << 4 | rng.randrange(0x10)),
+    (1, lambda rng: 0xE09E | rng.randrange(0x10) << 8),
+    (1, lambda rng: 0xE0A1 | rng.randrange(0x10) << 8),
+    (2, lambda rng: 0xF007 | rng.randrange(0x10) << 8),
+    (2, lambda rng: 0xF015 | rng.randrange(0x10) << 8),
+    (1, lambda rng: 0xF018 | rng.randrange(0x10) << 8),
+    (1, lambda rng: 0xF01E | rng.randrange(0x10) << 8),
+    (2, lambda rng: 0xF029 | rng.randrange(0x10) << 8),
+    (2, lambda rng: 0xF033 | rng.randrange(0x10) << 8),
+    (2, lambda rng: 0xF055 | rng.randrange(0x10) << 8),
+    (3, lambda rng: 0xF065 | rng.randrange(0x10) << 8),
+)
+# Instructions of the main loop, which also jumps and calls subroutines
+MAIN_INSTRUCTIONS = STRAIGHT_INSTRUCTIONS + (
+    (4, lambda rng: 0x1000 | main_address(rng)),
+    (3, lambda rng: 0x2000 | subroutine_address(rng)),
+)
+
+
+def random_opcodes(rng, instructions, count):
+    weights = [weight for weight, _ in instructions]
+    builders = [builder for _, builder in instructions]
+    return [builder(rng) for builder in rng.choices(builders, weights,
+                                                   k=count)]
+
+
+def generate(seed):
+    """
+    Return the program of seed: a main loop of random instructions calling
+    subroutines of random straight-line instructions, followed by random
+    data
+    """
+    rng = random.Random(seed)
+    # Skips before the jump back are skipping to another one
+    opcodes = random_opcodes(rng, MAIN_INSTRUCTIONS, MAIN_SIZE // 2 - 2)
+    opcodes += [0x1000 | PROGRAM_START] * 2
+    for _ in range(SUBROUTINES):
+        opcodes += random_opcodes(rng, STRAIGHT_INSTRUCTIONS,
+                                  SUBROUTINE_SIZE // 2 - 1)
+        opcodes.append(0x00EE)
+    opcodes.append(0x00EE)
+    return struct.pack('>{}H'.format(len(opcodes)), *opcodes) + \
+        bytes(rng.randrange(0x100) for _ in range(DATA_SIZE))
+
+
+def write_programs(directory, seeds):
+    """
+    Write the program of each seed to directory, returning their paths
+    """
+    paths = []
+    for seed in seeds:
+        path = os.path.join(directory, 'fuzz_{:06d}.ch8'.format(seed))
+        with open(path, 'wb') as rom_file:
+            rom_file.write(generate(seed))
+        paths.append(path)
+    return paths
+
+
+def fuzz(directory, seeds, cycles=DEFAULT_CYCLES, frames=None,
+         engine='compiler', interval=DEFAULT_INTERVAL, processes=None):
+    """
+    Check the programs of seeds, written to directory, returning their
+    diffcheck reports with their seed
+    """
+    roms = write_programs(directory, seeds)
+    results = check_roms(roms, cycles, frames, engine=engine,
+                         interval=interval, processes=processes)
+    for seed, result in zip(seeds, results):
+        result['seed'] = seed
+    return results
+
+
+def main(args):
+    seeds = range(args.seed, args.seed + args.count)
+    cycles = args.cycles
+    if cycles is None and args.frames is None:
+        cycles = DEFAULT_CYCLES
+
+    start_time = time.perf_counter()
+    if args.directory:
+        os.makedirs(args.directory, exist_ok=True)
+        results = fuzz(args.directory, seeds, cycles, args.frames,
+                       args.engine, args.interval, args.processes)
+    else:
+        with tempfile.TemporaryDirectory() as directory:
+            results = fuzz(directory, seeds, cycles, args.frames,
+                           args.engine, args.interval, args.processes)
+    elapsed = time.perf_counter() - start_time
+
+    divergences = [result for result in results if result['divergence']]
+    for result in divergences:
+        sys.stderr.write('Seed {}: {}\n'.format(
+            result['seed'], format_divergence(result['divergence'])))
+
+    # Random programs often end on an instruction failing on both engines
+    errors = sum(1 for result in results if result['error'])
+    sys.stderr.write('Checked {} programs in {:.2f}s, {} divergences, {} '
+                     'stopped by an error\n'.format(
+                         len(results), elapsed, len(divergences), errors))
+    if divergences:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Check an execution engine against the interpreter on '
+                    'random programs')
+
+    parser.add_argument('-n', '--count', type=int, default=DEFAULT_COUNT,
+                        help='number of programs (defaults to 100)')
+    parser.add_argument('-s', '--seed', type=int, default=0,
+                        help='seed of the first program (defaults to 0)')
+    parser.add_argument('-c', '--cycles', type=int,
+                        help='stop each program after CYCLES instructions\
+                         (defaults to 100000 without --frames)')
+    parser.add_argument('-f', '--frames', type=int,
+                        help='stop each program after FRAMES 60Hz frames')
+    parser.add_argument('-e', '--engine', default='compiler',
+                        choices=CHECKED_ENGINES, help='engine to check')
+    parser.add_argument('-i', '--interval', type=int,
+                        default=DEFAULT_INTERVAL,
+                        help='instructions between state comparisons')
+    parser.add_argument('-d', '--directory', type=str,
+                        help='directory to keep the programs in')
+    parser.add_argument('-p', '--processes', type=int,
+                        help='worker processes (defaults to CPU count)')
+
+    main(parser.parse_args())
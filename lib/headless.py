@@ -0,0 +1,103 @@
+"""
+Pygame-free backends allowing the CHIP-8 VM to run without a display,
+an audio device or a real-time clock.
+"""
+import time
+
+from lib.chip8 import TIMERS_UPDATE_FREQUENCY
+
+
+class Timeout(Exception):
+    pass
+
+
+class VirtualClock(object):
+    """
+    EventLoop replacement: time advances by one frame per tick and the VM is
+    never throttled.
+    """
+
+    def __init__(self, frequency=None):
+        self.keyboard = None
+        self.frequency = frequency or 1000*1000
+        self.frames = 0
+        self.poll_time = 0  # Input is scripted, there is nothing to poll
+        self.turbo = False  # Never throttled anyway
+        # time.perf_counter() value after which tick raises Timeout
+        self.deadline = None
+
+    def set_keyboard(self, keyboard):
+        self.keyboard = keyboard
+
+    def set_debug(self, debug):
+        pass
+
+    def get_frame(self):
+        """
+        Number of 60Hz frames elapsed in virtual time
+        """
+        return self.frames
+
+    def tick(self):
+        assert(self.keyboard is not None)
+
+        self.frames += 1
+        self.keyboard.update(self.frames)
+        if self.deadline is not None and time.perf_counter() > self.deadline:
+            raise Timeout('still running at frame {}'.format(self.frames))
+
+        return 1000 / TIMERS_UPDATE_FREQUENCY
+
+
+class ScriptedKeyboard(object):
+    """
+    Keyboard replacement fed from a script of (frame, key_state) pairs.
+    A key_state of None releases the current key.
+    """
+
+    def __init__(self, event_loop, script=()):
+        self.key_state = None
+        self.rewinding = False
+        self.turbo = False
+        self.event_loop = event_loop
+        self.script = sorted(script, key=lambda entry: entry[0])
+        self.next_entry = 0
+
+    def get_key_state(self):
+        return self.key_state
+
+    def is_exhausted(self):
+        """
+        Whether the script has no key state changes left
+        """
+        return self.next_entry == len(self.script)
+
+    def update(self, frame):
+        script = self.script
+        while self.next_entry < len(script) and \
+                script[self.next_entry][0] <= frame:
+            self.key_state = script[self.next_entry][1]
+            self.next_entry += 1
+
+
+class NullRenderer(object):
+    """
+    Renderer replacement discarding every frame
+    """
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.frames = 0
+
+    def refresh(self, display, dirty_rects=None):
+        self.show(dirty_rects)
+
+    def prepare(self, display):
+        pass
+
+    def show(self, dirty_rects=None):
+        self.frames += 1
+
+    def set_overlay(self, text):
+        pass
@@ -20,24 +20,42 @@ KEYBOARD_MAPPING = {
     K_d: 0xF
 }
 
+REWIND_KEY = K_BACKSPACE
+TURBO_KEY = K_TAB
+
 
 class Keyboard(object):
 
     def __init__(self, event_loop):
         self.key_state = None
+        self.rewinding = False  # Rewind key held
+        self.turbo = False  # Toggled by the turbo key
         self.event_loop = event_loop
 
     def get_key_state(self):
         return self.key_state
 
+    def is_exhausted(self):
+        # Players can always press another key
+        return False
+
     def update_key(self, event):
         if event.type == KEYDOWN:
             if event.key == K_ESCAPE:
                 sys.exit()
 
+            if event.key == REWIND_KEY:
+                self.rewinding = True
+
+            if event.key == TURBO_KEY:
+                self.turbo = not self.turbo
+
             if event.key in KEYBOARD_MAPPING.keys():
                 self.key_state = KEYBOARD_MAPPING[event.key]
 
         elif event.type == KEYUP:
-            self.key_state = None
+            if event.key == REWIND_KEY:
+                self.rewinding = False
+            elif event.key != TURBO_KEY:
+                self.key_state = None
 
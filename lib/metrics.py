@@ -0,0 +1,113 @@
+"""
+Live VM metrics: effective clock rate, frame rates, render and input poll
+times, and drift of the 60Hz timers from host time.
+
+Samples are taken every interval seconds of host time, available as
+Metrics.latest, and optionally dumped as JSON lines and shown on screen.
+"""
+import json
+import time
+
+from lib.chip8 import DISPLAY_WIDTH, TIMERS_UPDATE_FREQUENCY
+
+DEFAULT_INTERVAL = 1.0  # seconds
+OVERLAY_ROWS = 2  # Display rows redrawn under the overlay
+
+
+class Metrics(object):
+    """
+    Samples the counters of vm, its event loop and its presenter, writing
+    each sample as a JSON line to output and to the renderer overlay if
+    asked to
+    """
+
+    def __init__(self, vm, interval=DEFAULT_INTERVAL, output=None,
+                 overlay=False):
+        self.vm = vm
+        self.interval = interval
+        self.output = output
+        self.overlay = overlay
+        self.start = None  # (time, frames) of the first update
+        self.last = None  # Counters of the previous sample
+        self.latest = None  # Latest sample
+
+    def counters(self):
+        vm = self.vm
+        return {
+            'time': time.perf_counter(),
+            'instructions': vm.cycles,
+            'idle_instructions': vm.idle_cycles,
+            'frames': vm.frames,
+            'presented': vm.presenter.presented,
+            'render_time': vm.presenter.render_time,
+            'poll_time': vm.event_loop.poll_time,
+        }
+
+    def update(self):
+        """
+        Take a sample if interval elapsed, called at the end of every frame
+        """
+        now = time.perf_counter()
+        if self.last is None:
+            self.last = self.counters()
+            self.start = now, self.vm.frames
+            return
+
+        if now - self.last['time'] < self.interval:
+            return
+
+        self.latest = self.sample()
+
+        if self.output is not None:
+            self.output.write(json.dumps(self.latest) + '\n')
+            self.output.flush()
+
+        if self.overlay:
+            self.vm.renderer.set_overlay(format_sample(self.latest))
+            # Have the overlay redrawn even if the program draws nothing
+            self.vm.mark_dirty(0, 0, DISPLAY_WIDTH, OVERLAY_ROWS)
+
+    def sample(self):
+        """
+        Return the metrics since the previous sample
+        """
+        current = self.counters()
+        last = self.last
+        self.last = current
+
+        def delta(name):
+            return current[name] - last[name]
+
+        elapsed = delta('time') or 1e-9
+        frames = delta('frames')
+        presented = delta('presented')
+        start_time, start_frames = self.start
+
+        return {
+            'time': current['time'] - start_time,
+            'instructions': current['instructions'],
+            'frames': current['frames'],
+            'presented': current['presented'],
+            'effective_hz': delta('instructions') / elapsed,
+            # Share of instructions skipped in idle loops
+            'idle_ratio': delta('idle_instructions') /
+            delta('instructions') if delta('instructions') else 0,
+            'target_hz': self.vm.event_loop.frequency,
+            'frames_per_second': frames / elapsed,
+            'presented_per_second': presented / elapsed,
+            'render_ms': 1000 * delta('render_time') / presented
+            if presented else 0,
+            'input_poll_ms': 1000 * delta('poll_time') / frames
+            if frames else 0,
+            # Positive when timers run slower than host time
+            'timer_drift': current['time'] - start_time -
+            (current['frames'] - start_frames) / TIMERS_UPDATE_FREQUENCY,
+        }
+
+
+def format_sample(sample):
+    return '{:.3f}MHz {:.1f}fps {:.1f}presented/s render {:.2f}ms ' \
+           'drift {:+.2f}s'.format(
+               sample['effective_hz'] / 1e6, sample['frames_per_second'],
+               sample['presented_per_second'], sample['render_ms'],
+               sample['timer_drift'])
@@ -0,0 +1,98 @@
+"""
+Input movies: the key state changes of a session keyed by frame number,
+with the random seed and clock frequency needed to replay it exactly.
+
+Movies are a header followed by fixed size (frame, key) events, a key of
+RELEASED_KEY releasing the current key and one of END_KEY marking the last
+frame. They are recorded with pychip8.py --record and replayed headlessly at
+full speed with pychip8.py --replay.
+"""
+from collections import namedtuple
+import hashlib
+import struct
+
+MAGIC = b'C8MV'
+VERSION = 1
+HEADER = struct.Struct('>4sBId20s')  # magic, version, seed, frequency, sha1
+EVENT = struct.Struct('>IB')  # frame, key
+RELEASED_KEY = 0xFF
+END_KEY = 0xFE
+
+Movie = namedtuple('Movie', ('seed', 'frequency', 'program_hash', 'script',
+                             'frames'))
+
+
+class InvalidMovie(Exception):
+    pass
+
+
+def program_hash(vm):
+    """
+    Hash of the program memory of vm, identifying the program a movie was
+    recorded with
+    """
+    return hashlib.sha1(vm.memory[0x200:]).digest()
+
+
+class Recorder(object):
+    """
+    Writes the key state changes of vm to output, from a freshly loaded
+    program. The VM is seeded with seed, a random one if None.
+    """
+
+    def __init__(self, vm, output, seed=None):
+        self.vm = vm
+        self.output = output
+        self.key_state = None
+
+        vm.set_seed(seed)
+        output.write(HEADER.pack(MAGIC, VERSION, vm.random.state,
+                                 vm.event_loop.frequency, program_hash(vm)))
+
+    def record(self):
+        """
+        Log the key state if it changed, called at the end of every frame
+        """
+        key_state = self.vm.keyboard.get_key_state()
+        if key_state != self.key_state:
+            self.key_state = key_state
+            self.output.write(EVENT.pack(
+                self.vm.frames,
+                RELEASED_KEY if key_state is None else key_state))
+
+    def close(self):
+        self.output.write(EVENT.pack(self.vm.frames, END_KEY))
+        self.output.flush()
+
+
+def read_movie(movie_file):
+    """
+    Read a movie. Its script holds (frame, key_state) pairs for
+    headless.ScriptedKeyboard, frames is the length of the recording, or the
+    frame of its last event if it was interrupted.
+    """
+    header = movie_file.read(HEADER.size)
+    if len(header) < HEADER.size:
+        raise InvalidMovie('Truncated movie header')
+
+    magic, version, seed, frequency, sha1 = HEADER.unpack(header)
+    if magic != MAGIC or version != VERSION:
+        raise InvalidMovie('Unsupported movie format')
+
+    script = []
+    frames = None
+    while True:
+        data = movie_file.read(EVENT.size)
+        if len(data) < EVENT.size:
+            break
+
+        frame, key = EVENT.unpack(data)
+        if key == END_KEY:
+            frames = frame
+            break
+        script.append((frame, None if key == RELEASED_KEY else key))
+
+    if frames is None:
+        frames = script[-1][0] if script else 0
+
+    return Movie(seed, frequency, sha1, script, frames)
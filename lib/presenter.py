@@ -0,0 +1,213 @@
+"""
+Frame presentation: hands VM frames over to a renderer at a bounded rate,
+independently of how often the emulated program draws.
+"""
+import threading
+import time
+
+PRESENTATION_RATE = 60  # Hz
+# Frames arriving slightly early are still presented, so that host timer
+# jitter does not halve the presentation rate
+PRESENTATION_TOLERANCE = 0.1
+MAX_PENDING_RECTS = 64
+# Share of host time spent presenting in turbo mode, frames being skipped
+# as needed
+TURBO_RENDER_SHARE = 0.1
+# Weight of the latest presentation in the render cost moving average
+RENDER_COST_WEIGHT = 0.1
+
+# Byte -> its 8 bits as 0 or 1 bytes, most significant first
+PIXEL_BYTES = [bytes((byte >> bit) & 1 for bit in range(7, -1, -1))
+               for byte in range(0x100)]
+
+
+def rows_to_pixels(rows, width):
+    """
+    Expand display rows bitmasks to a bytearray holding one 0 or 1 byte per
+    pixel, row after row
+    """
+    return bytearray(b''.join(
+        PIXEL_BYTES[byte]
+        for row in rows
+        for byte in row.to_bytes(width // 8, 'big')))
+
+
+class Presenter(object):
+    """
+    Presents the latest submitted frame at most rate times per second of
+    host time, or on every update if rate is None. Dirty areas of frames
+    submitted in between are merged. In turbo mode, frames are presented
+    less often if needed to keep rendering under TURBO_RENDER_SHARE of host
+    time.
+    """
+
+    def __init__(self, renderer, rate=PRESENTATION_RATE):
+        self.renderer = renderer
+        self.rate_interval = 1 / rate if rate else 0
+        self.interval = self.rate_interval  # Host seconds between frames
+        self.turbo = False
+        self.render_cost = None  # Moving average of presentation times
+        self.last_presentation = None
+        self.rows = None  # Latest frame, None once presented
+        self.dirty_rects = []
+        self.presented = 0  # Presented frames
+        self.render_time = 0  # Host seconds spent presenting
+
+    def submit(self, rows, dirty_rects):
+        """
+        Make rows the latest frame, dirty_rects listing the (x, y, width,
+        height) areas changed since the previous one
+        """
+        self.rows = tuple(rows)
+
+        if self.dirty_rects is None:
+            return
+        self.dirty_rects.extend(dirty_rects)
+        if len(self.dirty_rects) > MAX_PENDING_RECTS:
+            # Redraw everything
+            self.dirty_rects = None
+
+    def take(self):
+        rows, dirty_rects = self.rows, self.dirty_rects
+        self.rows = None
+        self.dirty_rects = []
+        return rows, dirty_rects
+
+    def is_due(self, now):
+        if self.last_presentation is None:
+            return True
+        elapsed = now - self.last_presentation
+        return elapsed >= self.interval * (1 - PRESENTATION_TOLERANCE)
+
+    def set_turbo(self, turbo):
+        self.turbo = turbo
+        self.update_interval()
+
+    def update_interval(self):
+        interval = self.rate_interval
+        if self.turbo and self.render_cost is not None:
+            interval = max(interval, self.render_cost / TURBO_RENDER_SHARE)
+        self.interval = interval
+
+    def present(self, rows, dirty_rects):
+        start_time = time.perf_counter()
+        self.renderer.refresh(
+            rows_to_pixels(rows, self.renderer.width), dirty_rects)
+        self.account(time.perf_counter() - start_time)
+
+    def account(self, elapsed):
+        """
+        Count a presented frame which took elapsed host seconds to render
+        """
+        self.render_time += elapsed
+        self.presented += 1
+
+        if self.render_cost is None:
+            self.render_cost = elapsed
+        else:
+            self.render_cost += RENDER_COST_WEIGHT * (
+                elapsed - self.render_cost)
+        if self.turbo:
+            self.update_interval()
+
+    def update(self):
+        """
+        Present the latest frame if there is one and the rate allows it
+        """
+        if self.rows is None:
+            return
+
+        now = time.perf_counter()
+        if not self.is_due(now):
+            return
+
+        self.last_presentation = now
+        self.present(*self.take())
+
+    def close(self):
+        """
+        Present the pending frame, if any, regardless of the rate
+        """
+        if self.rows is not None:
+            self.present(*self.take())
+
+
+class ThreadedPresenter(Presenter):
+    """
+    Presenter expanding and scaling frames on its own thread. Submitted
+    frames are immutable copies, so the VM keeps drawing into its own
+    framebuffer meanwhile. SDL video calls are not thread-safe: prepared
+    frames are copied to the screen by update, on the main thread, before
+    the next one is prepared.
+    """
+
+    def __init__(self, renderer, rate=PRESENTATION_RATE):
+        super().__init__(renderer, rate)
+        self.lock = threading.Lock()
+        self.frame_ready = threading.Event()
+        # (dirty_rects, preparation time) of the frame to show
+        self.prepared = None
+        self.shown = threading.Event()  # Cleared while a frame is prepared
+        self.shown.set()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, rows, dirty_rects):
+        with self.lock:
+            super().submit(rows, dirty_rects)
+        self.frame_ready.set()
+
+    def update(self):
+        """
+        Show the frame prepared by the presentation thread, if any
+        """
+        prepared = self.prepared
+        if prepared is None:
+            return
+        self.prepared = None
+
+        dirty_rects, prepare_time = prepared
+        start_time = time.perf_counter()
+        self.renderer.show(dirty_rects)
+        self.account(prepare_time + time.perf_counter() - start_time)
+        self.shown.set()
+
+    def run(self):
+        while True:
+            self.frame_ready.wait()
+            self.frame_ready.clear()
+
+            if self.last_presentation is not None:
+                wait = self.last_presentation + self.interval - \
+                    time.perf_counter()
+                if wait > 0:
+                    time.sleep(wait)
+
+            # The scaled frame is free once the previous one is shown
+            self.shown.wait()
+            with self.lock:
+                rows, dirty_rects = self.take()
+
+            if rows is not None:
+                self.last_presentation = start_time = time.perf_counter()
+                self.renderer.prepare(
+                    rows_to_pixels(rows, self.renderer.width))
+                self.shown.clear()
+                self.prepared = (dirty_rects,
+                                 time.perf_counter() - start_time)
+
+            if not self.running:
+                break
+
+    def close(self):
+        """
+        Present the pending frame, if any, and stop the presentation thread
+        """
+        self.running = False
+        self.frame_ready.set()
+        # The thread may be waiting for its last frame to be shown
+        while self.thread.is_alive():
+            self.update()
+            self.thread.join(0.001)
+        self.update()
@@ -0,0 +1,144 @@
+"""
+Execution profiler for the CHIP-8 VM.
+
+Counts executions and host time per instruction class and per address,
+finds hot loops from backward jumps, and attributes time to the 2NNN/00EE
+call stack. Reports are written as text, and as folded stacks for flame
+graph tools such as flamegraph.pl.
+"""
+import time
+
+from lib.chip8 import Processor, UnsupportedOpCode
+from lib.trace import disassemble
+
+DEFAULT_TOP = 20
+
+
+class Profiler(object):
+    """
+    Times every instruction while running it through the VM processor. The
+    VM only calls the profiler while profiling, so that normal execution
+    costs nothing.
+    """
+
+    def __init__(self, vm):
+        self.vm = vm
+        self.names = {}  # Opcode -> handler name
+        # Handler name -> [executions, host nanoseconds]
+        self.classes = {}
+        self.address_counts = [0] * len(vm.memory)
+        self.address_times = [0] * len(vm.memory)
+        # (loop start, backward jump address) -> iterations
+        self.loops = {}
+        # Subroutine addresses of the current call stack
+        self.call_stack = []
+        # Folded call stack -> host nanoseconds
+        self.stacks = {}
+        self.count = 0
+        self.time = 0
+
+    def identify(self, opcode):
+        try:
+            name = Processor.identify(opcode)[0]
+        except UnsupportedOpCode:
+            name = 'unsupported'
+        self.names[opcode] = name
+        return name
+
+    def step(self, limit=1):
+        vm = self.vm
+        pc = vm.pc
+        opcode = vm.memory[pc] << 8 | vm.memory[pc + 1]
+        name = self.names.get(opcode) or self.identify(opcode)
+        call_stack = self.call_stack
+
+        start_time = time.perf_counter_ns()
+        try:
+            executed = vm.processor.step()
+        finally:
+            elapsed = time.perf_counter_ns() - start_time
+
+            self.count += 1
+            self.time += elapsed
+            self.address_counts[pc] += 1
+            self.address_times[pc] += elapsed
+
+            stats = self.classes.get(name)
+            if stats is None:
+                stats = self.classes[name] = [0, 0]
+            stats[0] += 1
+            stats[1] += elapsed
+
+            key = tuple(call_stack) + (name,)
+            self.stacks[key] = self.stacks.get(key, 0) + elapsed
+
+        # Follow the VM stack, which restores may also have changed
+        if vm.sp > len(call_stack) and name == 'call':
+            call_stack.append(opcode & 0x0FFF)
+        del call_stack[vm.sp:]
+
+        if vm.pc <= pc and name in ('jump', 'jump_v0'):
+            loop = (vm.pc, pc)
+            self.loops[loop] = self.loops.get(loop, 0) + 1
+
+        return executed
+
+    def hot_loops(self):
+        """
+        Return (start, end, iterations, host nanoseconds) loops, [start, end]
+        being the address range between a backward jump target and the jump
+        """
+        loops = []
+        for (start, end), iterations in self.loops.items():
+            loops.append((start, end, iterations,
+                          sum(self.address_times[start:end + 2])))
+        return sorted(loops, key=lambda loop: -loop[3])
+
+    def report(self, output, top=DEFAULT_TOP):
+        """
+        Write a text report of the top hot spots of each kind
+        """
+        total = self.time or 1
+
+        output.write('{} instructions in {:.3f}s of host time\n\n'.format(
+            self.count, self.time / 1e9))
+
+        output.write('Instruction classes\n')
+        output.write('{:<28} {:>10} {:>7} {:>9}\n'.format(
+            'class', 'count', 'time %', 'ns/instr'))
+        for name, (count, elapsed) in sorted(self.classes.items(),
+                                             key=lambda item: -item[1][1]):
+            output.write('{:<28} {:>10} {:>7.2f} {:>9.0f}\n'.format(
+                name, count, 100 * elapsed / total, elapsed / count))
+
+        output.write('\nHot addresses\n')
+        output.write('{:<7} {:<18} {:>10} {:>7}\n'.format(
+            'address', 'instruction', 'count', 'time %'))
+        memory = self.vm.memory
+        addresses = sorted(
+            (addr for addr, count in enumerate(self.address_counts) if count),
+            key=lambda addr: -self.address_times[addr])
+        for addr in addresses[:top]:
+            opcode = memory[addr] << 8 | memory[addr + 1]
+            output.write('0x{:03X}   {:<18} {:>10} {:>7.2f}\n'.format(
+                addr, disassemble(opcode), self.address_counts[addr],
+                100 * self.address_times[addr] / total))
+
+        output.write('\nHot loops\n')
+        output.write('{:<13} {:>10} {:>7}\n'.format(
+            'range', 'iterations', 'time %'))
+        for start, end, iterations, elapsed in self.hot_loops()[:top]:
+            output.write('0x{:03X}-0x{:03X} {:>10} {:>7.2f}\n'.format(
+                start, end, iterations, 100 * elapsed / total))
+
+    def write_folded(self, output):
+        """
+        Write host nanoseconds per call stack as folded stacks, one
+        'main;0x300;display 1234' line per stack
+        """
+        lines = []
+        for stack, elapsed in self.stacks.items():
+            frames = ['main'] + ['0x{:03X}'.format(addr)
+                                 for addr in stack[:-1]] + [stack[-1]]
+            lines.append('{} {}\n'.format(';'.join(frames), elapsed))
+        output.writelines(sorted(lines))
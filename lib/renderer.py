@@ -3,8 +3,9 @@ import pygame
 SCALE = 10
 WHITE = pygame.Color(255, 255, 255)
 BLACK = pygame.Color(0, 0, 0)
-
-BEEP_SOUND_FILE = 'resources/beep.wav'
+OVERLAY_COLOR = pygame.Color(255, 0, 0)
+OVERLAY_FONT_SIZE = 18
+OVERLAY_MARGIN = 2
 
 
 class Renderer(object):
@@ -12,24 +13,108 @@ class Renderer(object):
     def __init__(self, width, height):
         self.width = width
         self.height = height
+        pygame.display.init()
         self.surface = pygame.display.set_mode(
             (self.width * SCALE, self.height * SCALE))
         self.surface.fill(WHITE)
 
-        pygame.mixer.init(44100)
-        self.sound = pygame.mixer.Sound(BEEP_SOUND_FILE)
+        # 8-bit surfaces whose pixels are display cells, at 1:1 and SCALE:1
+        self.frame = pygame.Surface((self.width, self.height), 0, 8)
+        self.frame.set_palette([BLACK, WHITE])
+        self.scaled_frame = pygame.Surface(self.surface.get_size(), 0, 8)
+        self.scaled_frame.set_palette([BLACK, WHITE])
+
+        self.overlay = None  # Text drawn over the display
+        self.overlay_rect = None
+        self.font = None
+
+    def refresh(self, display, dirty_rects=None):
+        """
+        Redraw the (x, y, width, height) display areas listed in dirty_rects,
+        or the whole display if not given. display is a bytes-like buffer
+        holding one 0 or 1 byte per cell.
+        """
+        self.prepare(display)
+        self.show(dirty_rects)
+
+    def prepare(self, display):
+        """
+        Draw display cells to the scaled frame, off screen. No SDL video
+        call is made, so this may run on another thread than show.
+        """
+        self.copy_display(display)
+        pygame.transform.scale(self.frame, self.scaled_frame.get_size(),
+                               self.scaled_frame)
+
+    def show(self, dirty_rects=None):
+        """
+        Copy the prepared frame to the screen, from the main thread since
+        SDL video calls are not thread-safe
+        """
+        if dirty_rects is None:
+            self.surface.blit(self.scaled_frame, (0, 0))
+            self.draw_overlay()
+            pygame.display.update()
+            return
+
+        updated = [pygame.Rect(x * SCALE, y * SCALE,
+                               width * SCALE, height * SCALE)
+                   for x, y, width, height in set(dirty_rects)]
+        for rect in updated:
+            self.surface.blit(self.scaled_frame, rect, rect)
+
+        overlay_rect = self.draw_overlay()
+        if overlay_rect is not None:
+            updated.append(overlay_rect)
+
+        pygame.display.update(updated)
+
+    def set_overlay(self, text):
+        """
+        Draw text over the display from the next refresh on, None to remove
+        it
+        """
+        self.overlay = text
+
+    def draw_overlay(self):
+        """
+        Draw the overlay text, returning the screen area it changed
+        """
+        if self.overlay is None and self.overlay_rect is None:
+            return None
+
+        # Erase the previous text
+        area = self.overlay_rect
+        if area is not None:
+            self.surface.blit(self.scaled_frame, area, area)
+        self.overlay_rect = None
+
+        if self.overlay is not None:
+            if self.font is None:
+                pygame.font.init()
+                self.font = pygame.font.Font(None, OVERLAY_FONT_SIZE)
+            text = self.font.render(self.overlay, False, OVERLAY_COLOR)
+            self.overlay_rect = self.surface.blit(
+                text, (OVERLAY_MARGIN, OVERLAY_MARGIN))
+            area = self.overlay_rect.union(area) if area else \
+                self.overlay_rect
 
-    def refresh(self, display):
-        for i, p in enumerate(display):
-            scaled_x = (i % self.width) * SCALE
-            scaled_y = (i // self.width) * SCALE
-            color = p == 1 and WHITE or BLACK
+        return area
 
-            pygame.draw.rect(self.surface,
-                             color,
-                             (scaled_x, scaled_y, SCALE, SCALE))
+    def copy_display(self, display):
+        """
+        Copy display cells to the 1:1 frame pixels
+        """
+        pitch = self.frame.get_pitch()
+        pixels = self.frame.get_buffer()
 
-        pygame.display.update()
+        if pitch == self.width:
+            pixels.write(bytes(display), 0)
+        else:
+            for row in range(self.height):
+                start = row * self.width
+                pixels.write(bytes(display[start:start + self.width]),
+                             row * pitch)
 
-    def beep(self):
-        self.sound.play()
+        # Unlock the frame surface
+        del pixels
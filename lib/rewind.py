@@ -0,0 +1,91 @@
+"""
+Rewind history for interactive sessions.
+
+The VM state is recorded at the end of every interval frames. Each record
+only keeps the zlib compressed XOR of its state with the previous one, which
+is mostly zeros since little of memory and display changes from one frame to
+the next. Going back from the latest state undoes one delta at a time.
+"""
+from collections import deque
+import sys
+import zlib
+
+from lib import snapshot
+
+DEFAULT_BUDGET = 4 * 1024 * 1024  # bytes
+DELTA_COMPRESSION_LEVEL = 1
+
+
+def xor_bytes(a, b):
+    return (int.from_bytes(a, 'big') ^ int.from_bytes(b, 'big')).to_bytes(
+        len(a), 'big')
+
+
+class RewindBuffer(object):
+    """
+    Ring buffer of VM states, dropping the oldest ones to keep the recorded
+    deltas within budget bytes
+    """
+
+    def __init__(self, vm, budget=DEFAULT_BUDGET, interval=1):
+        self.vm = vm
+        self.budget = budget
+        self.interval = interval
+        self.deltas = deque()  # Compressed deltas to previous states
+        self.size = 0  # Bytes used by deltas
+        self.state = None  # Latest recorded state, encoded
+        self.frame = None  # VM frame of the latest recorded state
+
+    def __len__(self):
+        """
+        Number of states the VM can go back to
+        """
+        return len(self.deltas)
+
+    def record(self):
+        """
+        Record the VM state, called at the end of every frame
+        """
+        vm = self.vm
+        if self.frame is not None and vm.frames - self.frame < self.interval:
+            return
+
+        state = snapshot.encode(vm.snapshot())
+        if self.state is not None:
+            delta = zlib.compress(xor_bytes(state, self.state),
+                                  DELTA_COMPRESSION_LEVEL)
+            self.deltas.append(delta)
+            self.size += sys.getsizeof(delta)
+
+            while self.size > self.budget and self.deltas:
+                self.size -= sys.getsizeof(self.deltas.popleft())
+
+        self.state = state
+        self.frame = vm.frames
+
+    def step_back(self):
+        """
+        Restore the previous recorded state, or the latest one if the VM ran
+        past it. Returns False when there is no state to go back to.
+        """
+        if self.state is None:
+            return False
+
+        if self.vm.frames == self.frame:
+            if not self.deltas:
+                return False
+
+            delta = self.deltas.pop()
+            self.size -= sys.getsizeof(delta)
+            self.state = xor_bytes(self.state, zlib.decompress(delta))
+
+        state = snapshot.decode(self.state)
+        self.vm.restore(state)
+        self.frame = state.frames
+        return True
+
+    def clear(self):
+        self.deltas.clear()
+        self.size = 0
+        self.state = None
+        self.frame = None
@@ -0,0 +1,310 @@
+"""
+Frame streaming server: runs a headless CHIP-8 session in real time and
+streams its display to any number of viewers over TCP or a Unix socket,
+taking their key presses back.
+
+On connection the server sends HELLO, then FRAME messages listing the
+display rows which changed since the previous message sent to that viewer,
+starting from a blank display. Viewers send KEY messages, a key of
+RELEASED_KEY releasing the current key. A viewer which does not read fast
+enough misses frames and gets the rows changed since the last one it was
+sent, so that it never holds emulation back:
+
+    python3 -m lib.server program [-a localhost:8064 | -u socket]
+    python3 -m lib.server --watch [-a localhost:8064 | -u socket]
+"""
+import argparse
+import asyncio
+import struct
+import sys
+
+from lib import chip8
+from lib.batch import create_vm
+from lib.compiler import ENGINES
+
+MAGIC = b'C8FS'
+VERSION = 1
+HELLO = struct.Struct('>4sBBB')  # magic, version, width, height
+FRAME = struct.Struct('>BIB')  # FRAME_MESSAGE, frame, changed rows
+ROW = struct.Struct('>BQ')  # row, pixels, most significant bit on the left
+KEY = struct.Struct('>BB')  # KEY_MESSAGE, key
+FRAME_MESSAGE = 1
+KEY_MESSAGE = 2
+RELEASED_KEY = 0xFF
+
+DEFAULT_ADDRESS = 'localhost:8064'
+# Bytes left unsent to a viewer beyond which it misses frames
+MAX_PENDING_BYTES = 4096
+
+BLANK_ROWS = (0,) * chip8.DISPLAY_HEIGHT
+
+
+class InvalidStream(Exception):
+    pass
+
+
+def encode_frame(frame, rows, previous):
+    """
+    Return the FRAME message of the rows which differ from previous
+    """
+    changed = [(row, pixels) for row, (pixels, last)
+               in enumerate(zip(rows, previous)) if pixels != last]
+    return FRAME.pack(FRAME_MESSAGE, frame, len(changed)) + b''.join(
+        ROW.pack(row, pixels) for row, pixels in changed)
+
+
+class RemoteKeyboard(object):
+    """
+    Keyboard replacement pressed by viewers, the latest key message of any
+    viewer winning
+    """
+
+    def __init__(self):
+        self.key_state = None
+        self.rewinding = False
+        self.turbo = False
+
+    def get_key_state(self):
+        return self.key_state
+
+    def is_exhausted(self):
+        # Viewers can always press another key
+        return False
+
+    def update(self, frame):
+        pass
+
+
+class Viewer(object):
+    """
+    Connected viewer, with the display rows last sent to it
+    """
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.rows = BLANK_ROWS
+
+    def is_behind(self):
+        return self.writer.transport.get_write_buffer_size() > \
+            MAX_PENDING_BYTES
+
+
+class Session(object):
+    """
+    Runs vm at 60 frames per second, streaming its display to viewers
+    """
+
+    def __init__(self, vm):
+        self.vm = vm
+        self.viewers = set()
+        # Display rows after the latest frame, shared by up to date viewers
+        self.rows = BLANK_ROWS
+
+    async def run(self):
+        vm = self.vm
+        loop = asyncio.get_running_loop()
+        next_frame = loop.time()
+
+        vm.running = True
+        try:
+            while vm.running:
+                vm.run_frame()
+                self.broadcast()
+
+                next_frame += 1 / chip8.TIMERS_UPDATE_FREQUENCY
+                delay = next_frame - loop.time()
+                if delay < 0:
+                    # Late frames are not caught up on
+                    next_frame = loop.time()
+                    delay = 0
+                await asyncio.sleep(delay)
+        finally:
+            vm.presenter.close()
+            for viewer in list(self.viewers):
+                viewer.writer.close()
+
+    def broadcast(self):
+        """
+        Send the rows changed since their last message to viewers ready
+        for it
+        """
+        rows = tuple(self.vm.display_rows)
+        if rows != self.rows:
+            self.rows = rows
+
+        # Viewers sent the same rows last get the same message
+        messages = {}
+        for viewer in self.viewers:
+            if viewer.rows is self.rows or viewer.is_behind():
+                continue
+            message = messages.get(id(viewer.rows))
+            if message is None:
+                message = messages[id(viewer.rows)] = encode_frame(
+                    self.vm.frames, self.rows, viewer.rows)
+            viewer.writer.write(message)
+            viewer.rows = self.rows
+
+    async def connect(self, reader, writer):
+        """
+        Serve a viewer until it disconnects
+        """
+        viewer = Viewer(writer)
+        writer.write(HELLO.pack(MAGIC, VERSION, chip8.DISPLAY_WIDTH,
+                                chip8.DISPLAY_HEIGHT))
+        self.viewers.add(viewer)
+        # Send the current display right away
+        self.broadcast()
+
+        keyboard = self.vm.keyboard
+        try:
+            while True:
+                message, key = KEY.unpack(await reader.readexactly(KEY.size))
+                if message != KEY_MESSAGE:
+                    break
+                keyboard.key_state = None if key == RELEASED_KEY else key & 0xF
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.viewers.discard(viewer)
+            writer.close()
+
+
+def create_session(program, frequency=chip8.CLOCK_FREQUENCY, engine=None,
+                   seed=None):
+    vm = create_vm(frequency, engine, keyboard=RemoteKeyboard())
+    vm.load(program)
+    if seed is not None:
+        vm.set_seed(seed)
+    return Session(vm)
+
+
+async def serve(session, address=DEFAULT_ADDRESS, path=None):
+    """
+    Run session, accepting viewers on the host:port address, or the Unix
+    socket path if given
+    """
+    if path is not None:
+        server = await asyncio.start_unix_server(session.connect, path)
+    else:
+        host, port = address.rsplit(':', 1)
+        server = await asyncio.start_server(session.connect, host, int(port))
+
+    async with server:
+        await session.run()
+
+
+class Client(object):
+    """
+    Viewer side of the stream, keeping track of the display rows
+    """
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.width = None
+        self.height = None
+        self.rows = None
+        self.frame = None
+
+    @classmethod
+    async def connect(cls, address=DEFAULT_ADDRESS, path=None):
+        if path is not None:
+            reader, writer = await asyncio.open_unix_connection(path)
+        else:
+            host, port = address.rsplit(':', 1)
+            reader, writer = await asyncio.open_connection(host, int(port))
+
+        client = cls(reader, writer)
+        magic, version, client.width, client.height = HELLO.unpack(
+            await reader.readexactly(HELLO.size))
+        if magic != MAGIC or version != VERSION:
+            raise InvalidStream('Unsupported stream format')
+        client.rows = [0] * client.height
+        return client
+
+    async def read_frame(self):
+        """
+        Apply the next FRAME message to rows, returning the changed rows
+        """
+        message, self.frame, count = FRAME.unpack(
+            await self.reader.readexactly(FRAME.size))
+        if message != FRAME_MESSAGE:
+            raise InvalidStream('Unexpected message {}'.format(message))
+
+        data = await self.reader.readexactly(count * ROW.size)
+        changed = []
+        for offset in range(0, len(data), ROW.size):
+            row, pixels = ROW.unpack_from(data, offset)
+            self.rows[row] = pixels
+            changed.append(row)
+        return changed
+
+    def send_key(self, key):
+        """
+        Press key, or release the current one if None
+        """
+        self.writer.write(KEY.pack(
+            KEY_MESSAGE, RELEASED_KEY if key is None else key))
+
+    def close(self):
+        self.writer.close()
+
+
+async def watch(address, path, output):
+    """
+    Draw the stream on a terminal
+    """
+    client = await Client.connect(address, path)
+    try:
+        while True:
+            await client.read_frame()
+            lines = ['{:0{}b}'.format(pixels, client.width)
+                     .replace('0', ' ').replace('1', '#')
+                     for pixels in client.rows]
+            output.write('\x1b[H' + '\n'.join(lines) + '\n')
+            output.flush()
+    except asyncio.IncompleteReadError:
+        pass
+    finally:
+        client.close()
+
+
+def main(args):
+    if args.watch:
+        asyncio.run(watch(args.address, args.unix, sys.stdout))
+        return
+
+    if args.program is None:
+        sys.exit('A program is needed to serve')
+
+    session = create_session(args.program,
+                             args.frequency or chip8.CLOCK_FREQUENCY,
+                             ENGINES[args.engine], args.seed)
+    try:
+        asyncio.run(serve(session, args.address, args.unix))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Stream a CHIP-8 session to remote viewers')
+
+    parser.add_argument('program', type=str, nargs='?',
+                        help='path to ch8 program file to serve')
+    parser.add_argument('-a', '--address', default=DEFAULT_ADDRESS,
+                        help='host:port to listen on or connect to\
+                         (defaults to localhost:8064)')
+    parser.add_argument('-u', '--unix', type=str,
+                        help='Unix socket path to use instead of TCP')
+    parser.add_argument('-w', '--watch', action='store_true',
+                        help='draw the stream on the terminal instead of\
+                         serving')
+    parser.add_argument('-fr', '--frequency', type=float,
+                        help='CHIP-8 VM clock frequency (defaults to 1.76Mhz)')
+    parser.add_argument('-e', '--engine', default='interpreter',
+                        choices=ENGINES,
+                        help='execution engine')
+    parser.add_argument('-s', '--seed', type=int,
+                        help='seed of the CXNN random number generator')
+
+    main(parser.parse_args())
@@ -0,0 +1,102 @@
+"""
+VM state snapshots.
+
+Snapshots are immutable copies of a VM state, taken with Chip8.snapshot() and
+brought back with Chip8.restore(). They serialize to a versioned binary blob:
+a header followed by the zlib compressed state.
+"""
+from collections import namedtuple
+import struct
+import zlib
+
+MAGIC = b'C8SS'
+VERSION = 3
+HEADER = struct.Struct('>4sB')  # magic, version
+# pc, I, DT, ST, SP, register awaiting a key (-1 for none), random
+# generator state, frame cycles, cycles, frames, V0-VF, stack, display rows.
+# Registers are stored whole: shifts and I additions are not wrapped.
+STATE = struct.Struct('>HQHHBbIdQQ16I16H32Q')
+MEMORY_SIZE = 0xFFF + 1
+ENCODED_SIZE = STATE.size + MEMORY_SIZE
+
+Snapshot = namedtuple('Snapshot', (
+    'memory', 'stack', 'v_registers', 'i_register', 'dt', 'st', 'pc', 'sp',
+    'display_rows', 'key_register', 'random_state', 'frame_cycles', 'cycles',
+    'frames'))
+
+
+class InvalidSnapshot(Exception):
+    pass
+
+
+def encode(snapshot):
+    """
+    Return the uncompressed state of snapshot, ENCODED_SIZE bytes long
+    """
+    key_register = snapshot.key_register
+    try:
+        state = STATE.pack(
+            snapshot.pc, snapshot.i_register, snapshot.dt, snapshot.st,
+            snapshot.sp, -1 if key_register is None else key_register,
+            snapshot.random_state, snapshot.frame_cycles, snapshot.cycles,
+            snapshot.frames,
+            *(list(snapshot.v_registers) + list(snapshot.stack) +
+              list(snapshot.display_rows)))
+    except struct.error as e:
+        raise InvalidSnapshot('VM state out of range: {}'.format(e))
+
+    return state + bytes(snapshot.memory)
+
+
+def decode(state):
+    """
+    Return the snapshot of an encoded state. Its memory is returned as bytes.
+    """
+    if len(state) != ENCODED_SIZE:
+        raise InvalidSnapshot('Unexpected snapshot size')
+
+    fields = STATE.unpack_from(state)
+    pc, i_register, dt, st, sp, key_register, random_state, frame_cycles, \
+        cycles, frames = fields[:10]
+
+    return Snapshot(
+        memory=state[STATE.size:],
+        stack=fields[26:42],
+        v_registers=fields[10:26],
+        i_register=i_register,
+        dt=dt,
+        st=st,
+        pc=pc,
+        sp=sp,
+        display_rows=fields[42:],
+        key_register=None if key_register < 0 else key_register,
+        random_state=random_state,
+        frame_cycles=frame_cycles,
+        cycles=cycles,
+        frames=frames)
+
+
+def pack(snapshot):
+    """
+    Serialize snapshot to bytes
+    """
+    return HEADER.pack(MAGIC, VERSION) + zlib.compress(encode(snapshot))
+
+
+def unpack(data):
+    """
+    Deserialize a snapshot from bytes. Its memory is returned as bytes.
+    """
+    if len(data) < HEADER.size:
+        raise InvalidSnapshot('Truncated snapshot header')
+
+    magic, version = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise InvalidSnapshot('Unsupported snapshot format')
+
+    try:
+        state = zlib.decompress(data[HEADER.size:])
+    except zlib.error as e:
+        raise InvalidSnapshot('Corrupted snapshot: {}'.format(e))
+
+    return decode(state)
@@ -0,0 +1,69 @@
+"""
+CHIP-8 buzzer, sounding while the sound timer is above zero.
+
+The tone is synthesized once as a whole number of square wave periods, so
+that the mixer can loop it seamlessly on its own thread. The VM only starts
+and stops it, once per frame at most. Headless runs never create a Sound,
+so they never initialize the mixer.
+"""
+from array import array
+from functools import lru_cache
+
+import pygame
+
+SAMPLE_RATE = 44100
+MIXER_BUFFER_SIZE = 512  # Samples, small for a short start latency
+TONE_FREQUENCY = 440  # Hz
+TONE_PERIODS = 44  # Periods in the looped buffer, about 100ms
+TONE_AMPLITUDE = 0x1FFF  # Quarter of the signed 16-bit range
+FADE_OUT_TIME = 5  # ms, avoids a click on stop
+
+
+@lru_cache(maxsize=None)
+def tone_samples(rate, channels):
+    """
+    Return the signed 16-bit samples of the looped tone at rate, channels
+    interleaved
+    """
+    period = round(rate / TONE_FREQUENCY)
+    high = period // 2
+    samples = array('h')
+    for offset in range(period):
+        value = TONE_AMPLITUDE if offset < high else -TONE_AMPLITUDE
+        samples.extend([value] * channels)
+    return (samples * TONE_PERIODS).tobytes()
+
+
+class SoundUnavailable(Exception):
+    pass
+
+
+class Sound(object):
+    """
+    Plays the tone while the value given to update is above zero
+    """
+
+    def __init__(self):
+        try:
+            pygame.mixer.init(SAMPLE_RATE, -16, 1, MIXER_BUFFER_SIZE)
+        except pygame.error as e:
+            raise SoundUnavailable(str(e))
+        rate, _, channels = pygame.mixer.get_init()
+        self.tone = pygame.mixer.Sound(buffer=tone_samples(rate, channels))
+        self.channel = None  # Mixer channel of the playing tone
+
+    def update(self, st):
+        """
+        Start or stop the tone following sound timer st, called once per
+        frame
+        """
+        if st > 0:
+            if self.channel is None:
+                self.channel = self.tone.play(loops=-1)
+        elif self.channel is not None:
+            self.stop()
+
+    def stop(self):
+        if self.channel is not None:
+            self.channel.fadeout(FADE_OUT_TIME)
+            self.channel = None
@@ -0,0 +1,172 @@
+"""
+Instruction tracing for the CHIP-8 VM.
+
+Traces are sequences of fixed size binary records holding PC, opcode,
+V registers, I and SP as they were before the instruction ran. They are kept
+in a ring buffer or streamed to a file, and decoded to text offline with:
+
+    python3 -m lib.trace TRACE_FILE
+"""
+import argparse
+import struct
+import sys
+
+from lib.chip8 import Processor, UnsupportedOpCode
+
+MAGIC = b'C8TR'
+VERSION = 1
+HEADER = struct.Struct('>4sBB')  # magic, version, record size
+RECORD = struct.Struct('>HH16BHB')  # pc, opcode, V0-VF, I, SP
+
+DEFAULT_CAPACITY = 64 * 1024  # records
+
+MNEMONICS = {
+    'clear_display': 'CLS',
+    'return_from_subroutine': 'RET',
+    'jump': 'JP 0x{0:03X}',
+    'call': 'CALL 0x{0:03X}',
+    'skip_if_equal': 'SE V{0:X}, 0x{1:02X}',
+    'skip_if_not_equal': 'SNE V{0:X}, 0x{1:02X}',
+    'skip_if_registers_equal': 'SE V{0:X}, V{1:X}',
+    'load': 'LD V{0:X}, 0x{1:02X}',
+    'add': 'ADD V{0:X}, 0x{1:02X}',
+    'load_register': 'LD V{0:X}, V{1:X}',
+    'or_registers': 'OR V{0:X}, V{1:X}',
+    'and_registers': 'AND V{0:X}, V{1:X}',
+    'xor_registers': 'XOR V{0:X}, V{1:X}',
+    'add_registers': 'ADD V{0:X}, V{1:X}',
+    'sub_registers': 'SUB V{0:X}, V{1:X}',
+    'shift_right': 'SHR V{0:X}, V{1:X}',
+    'subn_registers': 'SUBN V{0:X}, V{1:X}',
+    'shift_left': 'SHL V{0:X}, V{1:X}',
+    'skip_if_registers_not_equal': 'SNE V{0:X}, V{1:X}',
+    'load_i': 'LD I, 0x{0:03X}',
+    'jump_v0': 'JP V0, 0x{0:03X}',
+    'random': 'RND V{0:X}, 0x{1:02X}',
+    'display': 'DRW V{0:X}, V{1:X}, 0x{2:X}',
+    'skip_if_key': 'SKP V{0:X}',
+    'skip_if_not_key': 'SKNP V{0:X}',
+    'load_delay_timer': 'LD V{0:X}, DT',
+    'wait_key': 'LD V{0:X}, K',
+    'set_delay_timer': 'LD DT, V{0:X}',
+    'set_sound_timer': 'LD ST, V{0:X}',
+    'add_i': 'ADD I, V{0:X}',
+    'load_font': 'LD F, V{0:X}',
+    'store_bcd': 'LD B, V{0:X}',
+    'store_registers': 'LD [I], V{0:X}',
+    'load_registers': 'LD V{0:X}, [I]',
+}
+
+
+class InvalidTrace(Exception):
+    pass
+
+
+def disassemble(opcode):
+    try:
+        name, operands = Processor.identify(opcode)
+    except UnsupportedOpCode:
+        return 'DW 0x{:04X}'.format(opcode)
+
+    return MNEMONICS[name].format(*operands)
+
+
+def format_record(record):
+    """
+    Format a (pc, opcode, V0, ..., VF, I, SP) record as text
+    """
+    pc, opcode = record[:2]
+    registers = record[2:18]
+    i_register, sp = record[18:]
+
+    return '0x{:03X}  {:04X}  {:<18} V={} I=0x{:03X} SP={}'.format(
+        pc, opcode, disassemble(opcode),
+        ' '.join('{:02X}'.format(r) for r in registers), i_register, sp)
+
+
+def read_records(trace_file):
+    """
+    Yield the records of a binary trace file
+    """
+    header = trace_file.read(HEADER.size)
+    if len(header) < HEADER.size:
+        raise InvalidTrace('Truncated trace header')
+
+    magic, version, record_size = HEADER.unpack(header)
+    if magic != MAGIC or version != VERSION or record_size != RECORD.size:
+        raise InvalidTrace('Unsupported trace format')
+
+    while True:
+        data = trace_file.read(RECORD.size)
+        if len(data) < RECORD.size:
+            break
+        yield RECORD.unpack(data)
+
+
+class Tracer(object):
+    """
+    Records every instruction before running it through the VM processor.
+    The VM only calls the tracer while tracing, so that untraced execution
+    costs nothing.
+
+    Records go to output if given, to a ring buffer of capacity records
+    otherwise. A logger additionally receives each record as text.
+    """
+
+    def __init__(self, vm, capacity=DEFAULT_CAPACITY, output=None,
+                 logger=None):
+        self.vm = vm
+        self.output = output
+        self.logger = logger
+        self.capacity = capacity
+        self.buffer = bytearray(capacity * RECORD.size)
+        self.index = 0  # Next ring buffer slot
+        self.count = 0  # Recorded instructions
+
+        if output is not None:
+            output.write(HEADER.pack(MAGIC, VERSION, RECORD.size))
+
+    def step(self, limit=1):
+        vm = self.vm
+        pc = vm.pc
+        opcode = vm.memory[pc] << 8 | vm.memory[pc + 1]
+        record = (pc, opcode) + tuple(r & 0xFF for r in vm.v_registers) + \
+            (vm.i_register & 0xFFFF, vm.sp)
+
+        if self.output is not None:
+            self.output.write(RECORD.pack(*record))
+        else:
+            RECORD.pack_into(self.buffer, self.index * RECORD.size, *record)
+            self.index = (self.index + 1) % self.capacity
+
+        self.count += 1
+
+        if self.logger is not None:
+            self.logger.debug(format_record(record))
+
+        return vm.processor.step()
+
+    def dump(self, output):
+        """
+        Write the ring buffer records to output, oldest first
+        """
+        output.write(HEADER.pack(MAGIC, VERSION, RECORD.size))
+
+        offset = self.index * RECORD.size
+        if self.count > self.capacity:
+            output.write(self.buffer[offset:])
+        output.write(self.buffer[:offset])
+
+
+def main(args):
+    with open(args.trace, 'rb') as trace_file:
+        for record in read_records(trace_file):
+            sys.stdout.write(format_record(record) + '\n')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Decode a CHIP-8 binary instruction trace to text')
+
+    parser.add_argument('trace', type=str, help='path to binary trace file')
+
+    main(parser.parse_args())
@@ -0,0 +1,495 @@
+"""
+Lockstep engine running many CHIP-8 machines at once on NumPy arrays.
+
+Every step fetches one instruction for each running machine, groups machines
+by instruction, and runs each group with vectorized operations. Instruction
+identification reuses Processor.INSTRUCTIONS and each handler mirrors the
+Processor handler of the same name. Machines which would raise in the
+reference interpreter are halted instead.
+
+Differences with the reference: CXNN draws from a NumPy generator, and
+register values above 0xFF, only produced by 8XYE, are truncated when
+stored to memory.
+
+    python3 -m lib.vector [-h] [options] program
+"""
+import argparse
+import sys
+import time
+
+import numpy as np
+
+from lib.chip8 import (Processor, HEX_CHARS, HEX_SPRITE_SIZE, DISPLAY_WIDTH,
+                       DISPLAY_HEIGHT, CLOCK_FREQUENCY,
+                       TIMERS_UPDATE_FREQUENCY, SUB_OPCODE_MASKS, MEMORY_SIZE,
+                       InvalidProgram)
+
+STACK_SIZE = 0xF + 1
+
+OPCODE_MASKS = np.array(SUB_OPCODE_MASKS, dtype=np.int64)
+SPRITE_SHIFT = np.uint64(DISPLAY_WIDTH - 8)
+
+
+class VectorChip8(object):
+    """
+    State of instances CHIP-8 machines, one row per machine
+    """
+
+    def __init__(self, instances, frequency=CLOCK_FREQUENCY, seed=None):
+        self.instances = instances
+        self.frequency = frequency
+        self.random = np.random.default_rng(seed)
+
+        self.memory = np.zeros((instances, MEMORY_SIZE), dtype=np.uint8)
+        self.stack = np.zeros((instances, STACK_SIZE), dtype=np.int64)
+        self.v_registers = np.zeros((instances, 0xF + 1), dtype=np.int64)
+        self.i_register = np.zeros(instances, dtype=np.int64)
+        self.dt = np.zeros(instances, dtype=np.int64)
+        self.st = np.zeros(instances, dtype=np.int64)
+        self.pc = np.zeros(instances, dtype=np.int64)
+        self.sp = np.zeros(instances, dtype=np.int64)
+        self.display_rows = np.zeros((instances, DISPLAY_HEIGHT),
+                                     dtype=np.uint64)
+
+        # Pressed key per machine, -1 for none
+        self.key_state = np.full(instances, -1, dtype=np.int64)
+        # Register awaiting a key press per machine (FX0A), -1 for none
+        self.waiting_key = np.full(instances, -1, dtype=np.int64)
+        self.halted = np.zeros(instances, dtype=bool)
+        self.cycles = np.zeros(instances, dtype=np.int64)
+
+        self.frames = 0
+        self.frame_cycles = 0
+
+        self.processor = VectorProcessor(self)
+
+        self.reset()
+
+    def reset(self):
+        self.memory[:] = 0
+        self.memory[:, :len(HEX_CHARS)] = HEX_CHARS
+        self.stack[:] = 0
+        self.v_registers[:] = 0
+        self.display_rows[:] = 0
+        self.i_register[:] = 0
+        self.dt[:] = 0
+        self.st[:] = 0
+        self.pc[:] = 0x200
+        self.sp[:] = 0
+        self.waiting_key[:] = -1
+        self.halted[:] = False
+        self.cycles[:] = 0
+        self.frames = 0
+
+    def load(self, program):
+        """
+        Load program, a file name or bytes, in every machine
+        """
+        if isinstance(program, str):
+            with open(program, 'rb') as program_file:
+                program = program_file.read()
+
+        if 0x200 + len(program) > MEMORY_SIZE:
+            raise InvalidProgram('Program does not fit in memory')
+
+        self.memory[:, 0x200:0x200 + len(program)] = np.frombuffer(
+            program, dtype=np.uint8)
+
+    def set_keys(self, key_state):
+        """
+        Set the pressed key of every machine, -1 for none
+        """
+        self.key_state[:] = key_state
+
+    def run_frame(self):
+        """
+        Run a 60Hz frame worth of instructions, then update timers
+        """
+        self.frame_cycles += self.frequency / TIMERS_UPDATE_FREQUENCY
+        budget = int(self.frame_cycles)
+        self.frame_cycles -= budget
+
+        for _ in range(budget):
+            if not self.processor.step():
+                break
+
+        running = ~self.halted
+        self.dt[running & (self.dt > 0)] -= 1
+        self.st[running & (self.st > 0)] -= 1
+        self.frames += 1
+
+    def run(self, frames):
+        for _ in range(frames):
+            self.run_frame()
+
+
+class VectorProcessor(object):
+    """
+    Runs instructions on every machine of a VectorChip8. Handlers bear the
+    names of their Processor counterparts and take the rows of the machines
+    running the instruction and their opcodes.
+    """
+
+    def __init__(self, vm):
+        self.vm = vm
+        self.handlers = dict(
+            (identifier, getattr(self, name))
+            for identifier, (name, _) in Processor.INSTRUCTIONS.items())
+
+    def halt(self, rows, failed):
+        """
+        Halt machines of rows where failed is set, return the mask of the
+        others
+        """
+        self.vm.halted[rows[failed]] = True
+        return ~failed
+
+    def step(self):
+        """
+        Run one instruction on every running machine. Returns the number of
+        machines which ran one.
+        """
+        vm = self.vm
+
+        resumed = np.nonzero((vm.waiting_key >= 0) & (vm.key_state >= 0))[0]
+        if resumed.size:
+            vm.v_registers[resumed, vm.waiting_key[resumed]] = \
+                vm.key_state[resumed]
+            vm.waiting_key[resumed] = -1
+
+        active = np.nonzero(~vm.halted & (vm.waiting_key < 0))[0]
+        pc = vm.pc[active]
+        valid = self.halt(active, pc + 1 >= MEMORY_SIZE)
+        active, pc = active[valid], pc[valid]
+        if not active.size:
+            return 0
+
+        opcodes = vm.memory[active, pc].astype(np.int64) << 8 | \
+            vm.memory[active, pc + 1]
+        vm.pc[active] = pc + 2
+        vm.cycles[active] += 1
+
+        identifiers = opcodes & OPCODE_MASKS[opcodes >> 12]
+        for identifier in np.unique(identifiers):
+            selected = identifiers == identifier
+            handler = self.handlers.get(int(identifier))
+            if handler is None:
+                vm.halted[active[selected]] = True
+            else:
+                handler(active[selected], opcodes[selected])
+
+        return active.size
+
+    def clear_display(self, rows, opcodes):
+        self.vm.display_rows[rows] = 0
+
+    def return_from_subroutine(self, rows, opcodes):
+        sp = self.vm.sp[rows] - 1
+        self.vm.sp[rows] = sp
+        valid = self.halt(rows, sp < 0)
+        rows, sp = rows[valid], sp[valid]
+        self.vm.pc[rows] = self.vm.stack[rows, sp]
+
+    def jump(self, rows, opcodes):
+        addr = opcodes & 0x0FFF
+        valid = self.halt(rows, addr < 0x200)
+        self.vm.pc[rows[valid]] = addr[valid]
+
+    def jump_v0(self, rows, opcodes):
+        addr = (opcodes & 0x0FFF) + self.vm.v_registers[rows, 0x0]
+        valid = self.halt(rows, (addr < 0x200) | (addr > 0xFFFF))
+        self.vm.pc[rows[valid]] = addr[valid]
+
+    def call(self, rows, opcodes):
+        sp = self.vm.sp[rows]
+        valid = self.halt(rows, sp >= STACK_SIZE)
+        rows, sp, opcodes = rows[valid], sp[valid], opcodes[valid]
+        self.vm.stack[rows, sp] = self.vm.pc[rows]
+        self.vm.sp[rows] = sp + 1
+        self.vm.pc[rows] = opcodes & 0x0FFF
+
+    # Instruction skips
+
+    def skip(self, rows, condition):
+        self.vm.pc[rows[condition]] += 2
+
+    def skip_if_equal(self, rows, opcodes):
+        x = (opcodes & 0x0F00) >> 8
+        self.skip(rows, self.vm.v_registers[rows, x] == opcodes & 0x00FF)
+
+    def skip_if_not_equal(self, rows, opcodes):
+        x = (opcodes & 0x0F00) >> 8
+        self.skip(rows, self.vm.v_registers[rows, x] != opcodes & 0x00FF)
+
+    def skip_if_registers_equal(self, rows, opcodes):
+        x = (opcodes & 0x0F00) >> 8
+        y = (opcodes & 0x00F0) >> 4
+        registers = self.vm.v_registers
+        self.skip(rows, registers[rows, x] == registers[rows, y])
+
+    def skip_if_registers_not_equal(self, rows, opcodes):
+        x = (opcodes & 0x0F00) >> 8
+        y = (opcodes & 0x00F0) >> 4
+        registers = self.vm.v_registers
+        self.skip(rows, registers[rows, x] != registers[rows, y])
+
+    def skip_if_key(self, rows, opcodes):
+        value_x = self.vm.v_registers[rows, (opcodes & 0x0F00) >> 8]
+        self.skip(rows, self.vm.key_state[rows] == value_x)
+
+    def skip_if_not_key(self, rows, opcodes):
+        value_x = self.vm.v_registers[rows, (opcodes & 0x0F00) >> 8]
+        self.skip(rows, self.vm.key_state[rows] != value_x)
+
+    # Register operations
+
+    def load(self, rows, opcodes):
+        self.vm.v_registers[rows, (opcodes & 0x0F00) >> 8] = opcodes & 0x00FF
+
+    def add(self, rows, opcodes):
+        x = (opcodes & 0x0F00) >> 8
+        value = self.vm.v_registers[rows, x] + (opcodes & 0x00FF)
+        self.vm.v_registers[rows, x] = np.where(value > 0xFF, value - 0x100,
+                                                value)
+
+    def register_operands(self, rows, opcodes):
+        """
+        Return rows, Vx and Vy of 8XYN instructions, halting the machines
+        using VF as an operand
+        """
+        x = (opcodes & 0x0F00) >> 8
+        y = (opcodes & 0x00F0) >> 4
+        valid = self.halt(rows, (x == 0xF) | (y == 0xF))
+        rows, x, y = rows[valid], x[valid], y[valid]
+        registers = self.vm.v_registers
+        return rows, x, registers[rows, x], registers[rows, y]
+
+    def load_register(self, rows, opcodes):
+        rows, x, _, value_y = self.register_operands(rows, opcodes)
+        self.vm.v_registers[rows, x] = value_y
+
+    def or_registers(self, rows, opcodes):
+        rows, x, value_x, value_y = self.register_operands(rows, opcodes)
+        self.vm.v_registers[rows, x] = value_x | value_y
+
+    def and_registers(self, rows, opcodes):
+        rows, x, value_x, value_y = self.register_operands(rows, opcodes)
+        self.vm.v_registers[rows, x] = value_x & value_y
+
+    def xor_registers(self, rows, opcodes):
+        rows, x, value_x, value_y = self.register_operands(rows, opcodes)
+        self.vm.v_registers[rows, x] = value_x ^ value_y
+
+    def add_registers(self, rows, opcodes):
+        rows, x, value_x, value_y = self.register_operands(rows, opcodes)
+        value = value_x + value_y
+        carry = value > 0xFF
+        self.vm.v_registers[rows, x] = np.where(carry, value - 0x100, value)
+        self.vm.v_registers[rows, 0xF] = carry
+
+    def sub_registers(self, rows, opcodes):
+        rows, x, value_x, value_y = self.register_operands(rows, opcodes)
+        value = value_x - value_y
+        self.vm.v_registers[rows, x] = np.where(value < 0, value + 0x100,
+                                                value)
+        self.vm.v_registers[rows, 0xF] = value_y > value_x
+
+    def shift_right(self, rows, opcodes):
+        rows, x, value_x, _ = self.register_operands(rows, opcodes)
+        self.vm.v_registers[rows, x] = value_x >> 1
+        self.vm.v_registers[rows, 0xF] = value_x & 0x1
+
+    def subn_registers(self, rows, opcodes):
+        rows, x, value_x, value_y = self.register_operands(rows, opcodes)
+        value = value_y - value_x
+        self.vm.v_registers[rows, x] = np.where(value < 0, value + 0x100,
+                                                value)
+        self.vm.v_registers[rows, 0xF] = value_x > value_y
+
+    def shift_left(self, rows, opcodes):
+        rows, x, value_x, _ = self.register_operands(rows, opcodes)
+        self.vm.v_registers[rows, x] = value_x << 1
+        self.vm.v_registers[rows, 0xF] = (value_x & 0x80) != 0
+
+    def load_i(self, rows, opcodes):
+        self.vm.i_register[rows] = opcodes & 0x0FFF
+
+    def random(self, rows, opcodes):
+        values = self.random_values(rows.size)
+        self.vm.v_registers[rows, (opcodes & 0x0F00) >> 8] = \
+            values & (opcodes & 0x00FF)
+
+    def random_values(self, count):
+        return self.vm.random.integers(0x0, 0xFF, size=count, endpoint=True)
+
+    def load_delay_timer(self, rows, opcodes):
+        self.vm.v_registers[rows, (opcodes & 0x0F00) >> 8] = self.vm.dt[rows]
+
+    def wait_key(self, rows, opcodes):
+        self.vm.waiting_key[rows] = (opcodes & 0x0F00) >> 8
+
+    def set_delay_timer(self, rows, opcodes):
+        self.vm.dt[rows] = self.vm.v_registers[rows, (opcodes & 0x0F00) >> 8]
+
+    def set_sound_timer(self, rows, opcodes):
+        self.vm.st[rows] = self.vm.v_registers[rows, (opcodes & 0x0F00) >> 8]
+
+    def add_i(self, rows, opcodes):
+        value_x = self.vm.v_registers[rows, (opcodes & 0x0F00) >> 8]
+        self.vm.i_register[rows] += value_x
+
+    def load_font(self, rows, opcodes):
+        value_x = self.vm.v_registers[rows, (opcodes & 0x0F00) >> 8]
+        self.vm.i_register[rows] = value_x * HEX_SPRITE_SIZE
+
+    def memory_operands(self, rows, opcodes, length):
+        """
+        Return rows, X and I of FX33/FX55/FX65 instructions, halting the
+        machines accessing memory out of bounds
+        """
+        x = (opcodes & 0x0F00) >> 8
+        addr = self.vm.i_register[rows]
+        valid = self.halt(rows, addr + length(x) > MEMORY_SIZE)
+        return rows[valid], x[valid], addr[valid]
+
+    def store_bcd(self, rows, opcodes):
+        rows, x, addr = self.memory_operands(rows, opcodes, lambda x: 3)
+        value = self.vm.v_registers[rows, x]
+        self.vm.memory[rows, addr] = value // 100 % 10
+        self.vm.memory[rows, addr + 1] = value // 10 % 10
+        self.vm.memory[rows, addr + 2] = value % 10
+
+    def store_registers(self, rows, opcodes):
+        rows, x, addr = self.memory_operands(rows, opcodes, lambda x: x + 1)
+        for r in range(0, 0xF + 1):
+            selected = r <= x
+            self.vm.memory[rows[selected], addr[selected] + r] = \
+                self.vm.v_registers[rows[selected], r]
+
+    def load_registers(self, rows, opcodes):
+        rows, x, addr = self.memory_operands(rows, opcodes, lambda x: x + 1)
+        for r in range(0, 0xF + 1):
+            selected = r <= x
+            self.vm.v_registers[rows[selected], r] = \
+                self.vm.memory[rows[selected], addr[selected] + r]
+
+    def display(self, rows, opcodes):
+        n = opcodes & 0x000F
+        memory = self.vm.memory
+        registers = self.vm.v_registers
+        display_rows = self.vm.display_rows
+        addr = self.vm.i_register[rows]
+        valid = self.halt(rows, addr + n > MEMORY_SIZE)
+        rows, opcodes, n, addr = rows[valid], opcodes[valid], n[valid], \
+            addr[valid]
+
+        register_x = registers[rows, (opcodes & 0x0F00) >> 8]
+        register_y = registers[rows, (opcodes & 0x00F0) >> 4]
+        shift = (register_x % DISPLAY_WIDTH).astype(np.uint64)
+        unshift = (DISPLAY_WIDTH - shift) % DISPLAY_WIDTH
+        collision = np.zeros(rows.size, dtype=np.uint64)
+
+        for line in range(int(n.max()) if n.size else 0):
+            # Lines past a sprite height draw a blank row
+            sprite = memory[rows, np.minimum(addr + line, MEMORY_SIZE - 1)]
+            sprite = np.where(line < n, sprite, 0).astype(np.uint64) << \
+                SPRITE_SHIFT
+            sprite = sprite >> shift | sprite << unshift
+            row = (register_y + line) % DISPLAY_HEIGHT
+            current = display_rows[rows, row]
+            collision |= current & sprite
+            display_rows[rows, row] = current ^ sprite
+
+        registers[rows, 0xF] = collision != 0
+
+
+def compare(vm, vector, index):
+    """
+    Return the names of the state fields differing between a Chip8 VM and
+    machine index of a VectorChip8
+    """
+    fields = {
+        'memory': (list(vm.memory), vector.memory[index].tolist()),
+        'stack': (list(vm.stack), vector.stack[index].tolist()),
+        'v_registers': (list(vm.v_registers),
+                        vector.v_registers[index].tolist()),
+        'i_register': (vm.i_register, int(vector.i_register[index])),
+        'dt': (vm.dt, int(vector.dt[index])),
+        'st': (vm.st, int(vector.st[index])),
+        'pc': (vm.pc, int(vector.pc[index])),
+        'sp': (vm.sp, int(vector.sp[index])),
+        'display_rows': (list(vm.display_rows),
+                         vector.display_rows[index].tolist()),
+        'cycles': (vm.cycles, int(vector.cycles[index])),
+    }
+    return sorted(name for name, (expected, actual) in fields.items()
+                  if expected != actual)
+
+
+def verify(program, frames, instances=4, frequency=CLOCK_FREQUENCY):
+    """
+    Run program on the reference interpreter and on a VectorChip8, comparing
+    every machine with the reference after each frame. Returns None, or the
+    (frame, differing fields) of the first mismatch.
+    """
+    from lib.batch import create_vm
+
+    vm = create_vm(frequency)
+    vm.load(program)
+    vector = VectorChip8(instances, frequency)
+    vector.load(program)
+
+    for frame in range(frames):
+        vm.start(max_frames=1)
+        vector.run_frame()
+        for index in range(instances):
+            fields = compare(vm, vector, index)
+            if fields:
+                return frame, fields
+
+    return None
+
+
+def main(args):
+    frequency = args.frequency or CLOCK_FREQUENCY
+
+    if args.verify:
+        mismatch = verify(args.program, args.frames, args.instances, frequency)
+        if mismatch is None:
+            sys.stderr.write('All machines match the reference interpreter\n')
+            return
+        sys.stderr.write('Mismatch at frame {}: {}\n'.format(
+            mismatch[0], ', '.join(mismatch[1])))
+        sys.exit(1)
+
+    vector = VectorChip8(args.instances, frequency)
+    vector.load(args.program)
+
+    start_time = time.perf_counter()
+    vector.run(args.frames)
+    elapsed = time.perf_counter() - start_time
+
+    cycles = int(vector.cycles.sum())
+    sys.stderr.write('Executed {} cycles on {} machines in {:.3f}s ({:.0f} '
+                     'cycles/s), {} halted\n'.format(
+                         cycles, args.instances, elapsed,
+                         cycles / elapsed if elapsed else 0,
+                         int(vector.halted.sum())))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Run many CHIP-8 machines in lockstep')
+
+    parser.add_argument('program', type=str,
+                        help='path to ch8 program file to execute')
+    parser.add_argument('-n', '--instances', type=int, default=1000,
+                        help='number of machines (defaults to 1000)')
+    parser.add_argument('-f', '--frames', type=int, default=60,
+                        help='60Hz frames to run (defaults to 60)')
+    parser.add_argument('-fr', '--frequency', type=float,
+                        help='CHIP-8 VM clock frequency (defaults to 1.76Mhz)')
+    parser.add_argument('--verify', action='store_true',
+                        help='compare machines with the reference interpreter\
+                         after each frame instead of measuring throughput')
+
+    main(parser.parse_args())
@@ -10,8 +10,10 @@ emulator served as reference for this project.
 import logging
 import argparse
 import sys
+import time
 
-from lib import chip8, event_loop, renderer, keyboard
+from lib import chip8
+from lib.compiler import ENGINES
 
 __author__ = 'Sébastien Volle'
 __copyright__ = 'Copyright 2013, Sébastien Volle'
@@ -22,25 +24,162 @@ __email__ = 'sebastien.volle@gmail.com'
 
 
 def main(args):
-    ev = event_loop.EventLoop(args.frequency or chip8.CLOCK_FREQUENCY)
-    kb = keyboard.Keyboard(ev)
+    # Movies replay from the freshly loaded program, frame by frame
+    if args.record and args.load_state:
+        sys.exit('--record cannot start from a state loaded with --load-state')
+    if args.record and args.rewind:
+        sys.exit('--record cannot be used with --rewind')
+    if args.replay and args.load_state:
+        sys.exit('--replay cannot start from a state loaded with --load-state')
+
+    frequency = args.frequency or chip8.CLOCK_FREQUENCY
+
+    replay = None
+    if args.replay:
+        from lib import movie
+        with open(args.replay, 'rb') as movie_file:
+            replay = movie.read_movie(movie_file)
+        frequency = replay.frequency
+
+    # Movies are replayed headlessly
+    headless_mode = args.headless or replay is not None
+
+    if headless_mode:
+        # No pygame import at all in headless mode
+        from lib import headless
+        ev = headless.VirtualClock(frequency)
+        kb = headless.ScriptedKeyboard(ev, replay.script if replay else ())
+        rd = headless.NullRenderer(chip8.DISPLAY_WIDTH, chip8.DISPLAY_HEIGHT)
+    else:
+        from lib import event_loop, renderer, keyboard
+        ev = event_loop.EventLoop(frequency)
+        kb = keyboard.Keyboard(ev)
+        rd = renderer.Renderer(chip8.DISPLAY_WIDTH, chip8.DISPLAY_HEIGHT)
+
     ev.set_keyboard(kb)
-    rd = renderer.Renderer(chip8.DISPLAY_WIDTH, chip8.DISPLAY_HEIGHT)
-    vm = chip8.Chip8(ev, kb, rd)
+
+    vm = chip8.Chip8(ev, kb, rd, ENGINES[args.engine])
+
+    if args.present_thread:
+        from lib import presenter
+        vm.set_presenter(presenter.ThreadedPresenter(rd))
 
     logger = logging.getLogger(__name__)
     logger.setLevel('INFO')
     ch = logging.StreamHandler(sys.stdout)
     logger.addHandler(ch)
 
+    if not headless_mode:
+        from lib import sound
+        try:
+            vm.set_sound(sound.Sound())
+        except sound.SoundUnavailable as e:
+            logger.warning('Sound disabled: {}'.format(e))
+
     if args.debug_pygame:
         ev.set_debug(True)
     if args.debug_chip8:
         vm.set_debug(True)
+    if args.no_idle_skip:
+        vm.skip_idle = False
+
+    if args.rewind:
+        from lib import rewind
+        vm.set_rewind(rewind.RewindBuffer(vm))
+
+    metrics_file = None
+    if args.metrics or args.metrics_overlay:
+        from lib.metrics import Metrics
+        if args.metrics == '-':
+            metrics_file = sys.stdout
+        elif args.metrics:
+            metrics_file = open(args.metrics, 'w')
+        vm.set_metrics(Metrics(vm, output=metrics_file,
+                               overlay=args.metrics_overlay))
+
+    profiler = None
+    if args.profile:
+        from lib.profiler import Profiler
+        profiler = Profiler(vm)
+        vm.set_profiler(profiler)
+
+    trace_file = None
+    if args.trace:
+        from lib import trace
+        trace_file = open(args.trace, 'wb')
+        vm.set_tracer(trace.Tracer(vm, output=trace_file))
+
+    capture_file = None
+    if args.capture:
+        from lib import capture
+        capture_file = open(args.capture, 'wb')
+        display_capture = capture.Capture(capture_file)
+        vm.set_capture(display_capture)
+
+    try:
+        vm.load(args.program)
+    except chip8.InvalidProgram as e:
+        sys.exit('{}: {}'.format(args.program, e))
+
+    max_frames = args.frames
+    if replay is not None:
+        if movie.program_hash(vm) != replay.program_hash:
+            sys.exit('{} was not recorded with {}'.format(
+                args.replay, args.program))
+        vm.set_seed(replay.seed)
+        max_frames = max_frames or max(replay.frames, 1)
+    elif args.seed is not None:
+        vm.set_seed(args.seed)
+
+    movie_file = None
+    if args.record:
+        from lib import movie
+        movie_file = open(args.record, 'wb')
+        recorder = movie.Recorder(vm, movie_file, args.seed)
+        vm.set_recorder(recorder)
+
+    if args.load_state:
+        with open(args.load_state, 'rb') as state_file:
+            vm.restore(state_file.read())
+
+    if headless_mode:
+        logger.info('Headless emulation started')
+    else:
+        logger.info('Emulation started. Press Escape to quit')
+
+    start_cycles = vm.cycles
+    start_time = time.perf_counter()
+    try:
+        vm.start(args.cycles, max_frames)
+    finally:
+        if trace_file is not None:
+            trace_file.close()
+        if capture_file is not None:
+            display_capture.close(vm.frames)
+            capture_file.close()
+        if movie_file is not None:
+            recorder.close()
+            movie_file.close()
+        if metrics_file not in (None, sys.stdout):
+            metrics_file.close()
+        if profiler is not None:
+            with open(args.profile, 'w') as report_file:
+                profiler.report(report_file)
+            with open(args.profile + '.folded', 'w') as folded_file:
+                profiler.write_folded(folded_file)
+        # Escape quits interactive sessions through sys.exit
+        if args.save_state:
+            from lib import snapshot
+            with open(args.save_state, 'wb') as state_file:
+                state_file.write(snapshot.pack(vm.snapshot()))
+    elapsed = time.perf_counter() - start_time
 
-    vm.load(args.program)
-    logger.info('Emulation started. Press Escape to quit')
-    vm.start()
+    if vm.blocked:
+        logger.warning('Stopped waiting for a key with no input left')
+    if headless_mode:
+        cycles = vm.cycles - start_cycles
+        logger.info('Executed {} cycles in {:.3f}s ({:.0f} cycles/s)'.format(
+            cycles, elapsed, cycles / elapsed if elapsed else 0))
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
@@ -55,5 +194,48 @@ if __name__ == '__main__':
                         help='display debug output from CHIP-8 emulator')
     parser.add_argument('-fr', '--frequency', type=float,
                         help='CHIP-8 VM clock frequency (defaults to 1.76Mhz)')
+    parser.add_argument('-hl', '--headless', action='store_true',
+                        help='run without display, sound or pygame, at full\
+                         CPU speed')
+    parser.add_argument('-c', '--cycles', type=int,
+                        help='stop after executing CYCLES instructions')
+    parser.add_argument('-f', '--frames', type=int,
+                        help='stop after running FRAMES 60Hz frames')
+    parser.add_argument('-t', '--trace', type=str,
+                        help='write a binary instruction trace to TRACE,\
+                         decoded with python3 -m lib.trace TRACE')
+    parser.add_argument('-cp', '--capture', type=str,
+                        help='record the display to CAPTURE, converted to\
+                         images with python3 -m lib.capture CAPTURE OUTPUT')
+    parser.add_argument('-pf', '--profile', type=str,
+                        help='write a profile report to PROFILE and folded\
+                         call stacks for flame graphs to PROFILE.folded')
+    parser.add_argument('-m', '--metrics', type=str,
+                        help='write metrics every second to METRICS as JSON\
+                         lines, - for stdout')
+    parser.add_argument('-mo', '--metrics-overlay', action='store_true',
+                        help='show metrics over the display')
+    parser.add_argument('-pt', '--present-thread', action='store_true',
+                        help='present frames from a separate thread')
+    parser.add_argument('-e', '--engine', default='interpreter',
+                        choices=ENGINES,
+                        help='execution engine, the compiler translates ROM\
+                         code blocks to Python functions')
+    parser.add_argument('-ni', '--no-idle-skip', action='store_true',
+                        help='run idle loops instruction by instruction\
+                         instead of skipping to the next frame')
+    parser.add_argument('-rw', '--rewind', action='store_true',
+                        help='keep a few minutes of history, played backwards\
+                         while Backspace is held')
+    parser.add_argument('-s', '--seed', type=int,
+                        help='seed of the CXNN random number generator')
+    parser.add_argument('-r', '--record', type=str,
+                        help='record key presses to the RECORD movie file')
+    parser.add_argument('-rp', '--replay', type=str,
+                        help='replay the REPLAY movie file headlessly')
+    parser.add_argument('-ls', '--load-state', type=str,
+                        help='start from the state saved in LOAD_STATE')
+    parser.add_argument('-ss', '--save-state', type=str,
+                        help='save the VM state to SAVE_STATE on exit')
 
-    main(parser.parse_args())
\ No newline at end of file
+    main(parser.parse_args())